@@ -2,16 +2,34 @@
 """Aggregator with extensions support"""
 
 import argparse
+import ast
+import asyncio
+import bisect
+import collections
 import contextlib
+import cProfile
+import functools
+import hashlib
+import heapq
 import importlib
+import io
+import itertools
+import json
 import logging
+import math
 import multiprocessing
 import os
+import pstats
+import random
+import shutil
 import signal
 import socket
 import sys
+import tempfile
+import threading
 import time
 from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
 from logging.handlers import RotatingFileHandler
 
 import grpc
@@ -21,7 +39,96 @@ import aggregator_pb2
 import aggregator_pb2_grpc
 import prctl
 
-_PROCESS_COUNT = 4
+# seconds between checks whether the server must be recycled
+_RECYCLE_CHECK_INTERVAL = 5
+# seconds for in-flight requests of recycled server
+_RECYCLE_GRACE = 60
+# max seconds between restarts of crashed worker
+_BACKOFF_MAX = 60
+# seconds of worker run after which its restart backoff is reset
+_BACKOFF_RESET = 60
+# decoded configs and reusable plugins cached by every servicer thread
+_PLUGIN_CACHE_SIZE = 256
+# host results of the streamed group decoded and folded in to the partial state at once
+_STREAM_BATCH = 64
+# upper bounds of latency histograms buckets in seconds
+_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# upper bounds of size histograms buckets in bytes: 1Kb .. 256Mb
+_SIZE_BUCKETS = tuple(4 ** i for i in range(5, 15))
+# requests of the whole metahost are admitted before per host ones (lower is first)
+_PRIORITIES = {"AggregateHost": 1}
+# weight of the last request in the moving average of requests duration per payload byte
+_DURATION_WEIGHT = 0.2
+# seconds in which the expected duration halves without new requests,
+# requests are not rejected up front by the expected duration older than the TTL
+_DURATION_HALF_LIFE = 10
+_DURATION_TTL = 60
+# seconds between checks whether the client of the queued request has gone
+_QUEUE_POLL_INTERVAL = 1
+# metahosts which partial states of recent frames are kept for sliding windows
+_WINDOW_KEYS = 4096
+# methods which requests are captured for replay
+_CAPTURED = frozenset(("AggregateHost", "AggregateGroup", "AggregateGroupStream", "AggregatePartial",
+                       "AggregateFinalize", "MergePartials", "AggregateHierarchy"))
+
+
+def _timed_unpack(items, timer):
+    """Decoded items, time of decoding is the nested unpack phase of the timer"""
+    for item in items:
+        with timer.measure("unpack"):
+            value = msgpack.unpackb(item, raw=False)
+        yield value
+
+
+def _stream_payload(first, request_iterator):
+    """Payload items of all messages of the stream"""
+    yield from first.payload
+    for chunk in request_iterator:
+        yield from chunk.payload
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    batch = list(itertools.islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(iterator, size))
+
+
+def _first_chunk(request_iterator, context):
+    first = next(request_iterator, None)
+    if first is None:
+        context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+        msg = "Empty stream"
+        context.set_details(msg)
+        raise ValueError(msg)
+    return first
+
+
+def _reject(context, code, msg):
+    context.set_code(code)
+    context.set_details(msg)
+    raise RuntimeError(msg)
+
+
+def _check_deadline(context):
+    """
+    Cooperative cancellation between phases of the request,
+    the rest of its work is wasted if the client has gone or the deadline is exceeded
+    """
+    remaining = context.time_remaining()
+    if (remaining is not None and remaining <= 0) or not context.is_active():
+        _reject(context, grpc.StatusCode.DEADLINE_EXCEEDED, "Deadline exceeded")
+
+
+def _admitted(method):
+    """Unary servicer method runs under admission control of the servicer"""
+    @functools.wraps(method)
+    def admitted(self, request, context):
+        with self.admit(method.__name__, request.class_name, context, request.ByteSize()):
+            return method(self, request, context)
+
+    return admitted
 
 
 class RidAdapter(logging.LoggerAdapter):
@@ -29,17 +136,432 @@ class RidAdapter(logging.LoggerAdapter):
         return '%s.%s %s' % (self.extra['rid'], self.extra['klass'], msg), kwargs
 
 
+class _LazyPlugin():
+    """Class of the plugin module which is not imported yet"""
+
+    def __init__(self, module, plugin_file):
+        self.module = module
+        self.plugin_file = plugin_file
+
+
+class _Stats():
+    """
+    Histograms of requests latency and sizes by method, class and phase,
+    in-flight requests and queue depths reported by gauges
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> callable returning the current value
+        self.gauges = {}
+        self.in_flight = 0
+        self.histograms = {}
+        self.errors = collections.Counter()
+
+    def observe(self, section, method, class_name, name, value):
+        bounds = _LATENCY_BUCKETS if section == "latency" else _SIZE_BUCKETS
+        key = (section, method, class_name, name)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                # counts of buckets, count of values over the last bound and sum of values
+                hist = self.histograms[key] = [0] * (len(bounds) + 2)
+            hist[bisect.bisect_left(bounds, value)] += 1
+            hist[-1] += value
+
+    def begin(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def end(self, method, seconds, failed=False):
+        self.observe("latency", method, "", "request", seconds)
+        with self.lock:
+            self.in_flight -= 1
+            if failed:
+                self.errors[method] += 1
+
+    def export(self):
+        """Histograms in the form for merge, e.g. from pool processes"""
+        with self.lock:
+            return {key: list(hist) for key, hist in self.histograms.items()}
+
+    def merge(self, histograms):
+        with self.lock:
+            for key, hist in histograms.items():
+                current = self.histograms.get(key)
+                if current is None:
+                    self.histograms[key] = hist
+                else:
+                    self.histograms[key] = [i + j for i, j in zip(current, hist)]
+
+    def snapshot(self, reset=False):
+        """Json compatible view of stats: section -> method -> class -> name -> histogram"""
+        with self.lock:
+            histograms = self.histograms
+            errors = dict(self.errors)
+            if reset:
+                self.histograms = {}
+                self.errors = collections.Counter()
+            result = {"in_flight": self.in_flight, "errors": errors}
+
+        for name, gauge in self.gauges.items():
+            result[name] = gauge()
+        for (section, method, class_name, name), hist in histograms.items():
+            bounds = _LATENCY_BUCKETS if section == "latency" else _SIZE_BUCKETS
+            buckets = dict(zip(map(str, bounds + ("+Inf", )), itertools.accumulate(hist[:-1])))
+            view = {"count": sum(hist[:-1]), "sum": hist[-1], "buckets": buckets}
+            result.setdefault(section, {}).setdefault(method, {}).setdefault(class_name, {})[name] = view
+        return result
+
+
+class _Timer():
+    """Records durations of consecutive phases of the request"""
+
+    def __init__(self, stats, method, class_name):
+        self.stats = stats
+        self.method = method
+        self.class_name = class_name
+        self.start = self.last = time.perf_counter()
+        # durations of phases done within the current one, such as decoding
+        # of lazy payload while the plugin iterates it, they are recorded apart
+        self.nested = collections.Counter()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        duration = now - self.last
+        for nested, spent in self.nested.items():
+            self.stats.observe("latency", self.method, self.class_name, nested, spent)
+            duration -= spent
+        self.nested.clear()
+        self.stats.observe("latency", self.method, self.class_name, phase, duration)
+        self.last = now
+
+    @contextlib.contextmanager
+    def measure(self, phase):
+        """Work of the nested phase"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.nested[phase] += time.perf_counter() - start
+
+    def add(self, phase, duration):
+        """Phase made of many intervals, such as per item work of the batch"""
+        self.stats.observe("latency", self.method, self.class_name, phase, duration)
+        self.last = time.perf_counter()
+
+    def size(self, name, size):
+        self.stats.observe("bytes", self.method, self.class_name, name, size)
+
+    def done(self):
+        self.stats.observe("latency", self.method, self.class_name, "total", time.perf_counter() - self.start)
+
+
+class _RawProfile():
+    """Profile stats collected in other process, in the form pstats.Stats can load"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class _Profiler():
+    """Sampling cProfile of plugin calls of a single class, switched at runtime"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.class_name = ""
+        self.every = 0
+        self.calls = 0
+        self.samples = 0
+        self.stats = None
+
+    def configure(self, class_name, every):
+        """Profile every n-th call of the class, returns report of the previous profiling"""
+        with self.lock:
+            report = self.report()
+            self.class_name = class_name
+            self.every = every if class_name else 0
+            self.calls = 0
+            self.samples = 0
+            self.stats = None
+        return report
+
+    def sampled(self, class_name):
+        if not self.every or class_name != self.class_name:
+            return False
+        with self.lock:
+            self.calls += 1
+            return (self.calls - 1) % self.every == 0
+
+    @contextlib.contextmanager
+    def profile(self, class_name):
+        if not self.sampled(class_name):
+            yield
+            return
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.add(profile)
+
+    def add(self, profile):
+        with self.lock:
+            self.samples += 1
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+
+    def raw_stats(self):
+        return self.stats.stats if self.stats is not None else None
+
+    def report(self, limit=50):
+        if self.stats is None:
+            return ""
+        output = io.StringIO()
+        output.write("{} of {} calls of {} are profiled\n".format(self.samples, self.calls, self.class_name))
+        self.stats.stream = output
+        self.stats.sort_stats("cumulative").print_stats(limit)
+        return output.getvalue()
+
+
+class _Capture():
+    """
+    Sampled requests written with their timings to the rotating file, aggregator/replay.py replays them.
+    The file is a stream of msgpack maps: method, class_name, request - serialized message
+    (list of them for the stream), start - unix time, duration - seconds, error - details or None
+    """
+
+    def __init__(self, path, sample=1.0, max_bytes=0, backups=3):
+        self.lock = threading.Lock()
+        self.path = path
+        self.sample = sample
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.output = open(path, 'ab')
+        self.size = self.output.tell()
+
+    def track(self, method, request, streaming=False):
+        """Request to pass to the method and record of it for `write`, None if the request is not sampled"""
+        if method not in _CAPTURED or random.random() >= self.sample:
+            return request, None
+        record = {"method": method, "start": time.time()}
+        if streaming:
+            chunks = record["request"] = []
+            return self._tee(request, chunks), record
+        record["request"] = request
+        return request, record
+
+    @staticmethod
+    def _tee(request_iterator, chunks):
+        for chunk in request_iterator:
+            chunks.append(chunk)
+            yield chunk
+
+    def write(self, record, duration, error=None):
+        request = record["request"]
+        if isinstance(request, list):
+            record["class_name"] = request[0].class_name if request else ""
+            record["request"] = [chunk.SerializeToString() for chunk in request]
+        else:
+            record["class_name"] = request.class_name
+            record["request"] = request.SerializeToString()
+        record["duration"] = duration
+        record["error"] = error
+        data = msgpack.packb(record, use_bin_type=True)
+        with self.lock:
+            if self.max_bytes and self.size and self.size + len(data) > self.max_bytes:
+                self._rotate()
+            self.output.write(data)
+            self.output.flush()
+            self.size += len(data)
+
+    def _rotate(self):
+        """The same naming as RotatingFileHandler: path.1 is the newest backup"""
+        self.output.close()
+        for idx in range(self.backups - 1, 0, -1):
+            source = "{}.{}".format(self.path, idx)
+            if os.path.exists(source):
+                os.replace(source, "{}.{}".format(self.path, idx + 1))
+        if self.backups > 0:
+            os.replace(self.path, self.path + ".1")
+        self.output = open(self.path, 'wb')
+        self.size = 0
+
+
+class _Admission():
+    """
+    Admission control of plugin calls: at most `concurrency` requests run at once,
+    up to `queue_size` wait ordered by priority and deadline, the rest are rejected
+    with RESOURCE_EXHAUSTED, so the client can retry on a less loaded aggregator.
+    Request is rejected without running if its deadline can not be met by the expected
+    duration: the recent duration per payload byte of requests of the same method and class
+    scaled by the request size. The expected duration decays while requests are not admitted,
+    so one slow request does not lock out short deadlines
+    """
+
+    def __init__(self, concurrency, queue_size):
+        self.cond = threading.Condition()
+        self.free = concurrency
+        self.queue_size = queue_size
+        # heap of [priority, start at the latest, arrival order]
+        self.waiting = []
+        self.arrivals = itertools.count()
+        # (method, class_name) -> [moving average of duration per payload byte in seconds, update time]
+        self.durations = {}
+
+    def _per_byte(self, key, now):
+        """Decayed duration per byte of requests, None without recent requests"""
+        duration = self.durations.get(key)
+        if duration is None or now - duration[1] > _DURATION_TTL:
+            return None
+        return duration[0] * 0.5 ** ((now - duration[1]) / _DURATION_HALF_LIFE)
+
+    @contextlib.contextmanager
+    def admit(self, method, class_name, context, size=0):
+        """Run the request of `size` bytes when a slot is free, or reject it"""
+        key = (method, class_name)
+        size = max(size, 1)
+        with self.cond:
+            per_byte = self._per_byte(key, time.monotonic())
+        expected = 0.0 if per_byte is None else per_byte * size
+        remaining = context.time_remaining()
+        if remaining is not None and remaining < expected:
+            _reject(context, grpc.StatusCode.DEADLINE_EXCEEDED,
+                    "Deadline can not be met, expected duration {:.3f} s".format(expected))
+        latest = math.inf if remaining is None else time.monotonic() + remaining - expected
+        self._acquire(_PRIORITIES.get(method, 0), latest, context)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            now = time.monotonic()
+            sample = (now - start) / size
+            with self.cond:
+                average = self._per_byte(key, now)
+                if average is None:
+                    average = sample
+                self.durations[key] = [average + (sample - average) * _DURATION_WEIGHT, now]
+                self.free += 1
+                self.cond.notify_all()
+
+    def _acquire(self, priority, latest, context):
+        with self.cond:
+            if self.free > 0 and not self.waiting:
+                self.free -= 1
+                return
+            if len(self.waiting) >= self.queue_size:
+                _reject(context, grpc.StatusCode.RESOURCE_EXHAUSTED, "Aggregator queue is full")
+
+            entry = [priority, latest, next(self.arrivals)]
+            heapq.heappush(self.waiting, entry)
+            while self.free <= 0 or self.waiting[0] is not entry:
+                timeout = latest - time.monotonic()
+                if timeout <= 0 or not context.is_active():
+                    self.waiting.remove(entry)
+                    heapq.heapify(self.waiting)
+                    self.cond.notify_all()
+                    _reject(context, grpc.StatusCode.DEADLINE_EXCEEDED, "Deadline can not be met in the queue")
+                self.cond.wait(min(timeout, _QUEUE_POLL_INTERVAL))
+            heapq.heappop(self.waiting)
+            self.free -= 1
+            if self.free > 0 and self.waiting:
+                self.cond.notify_all()
+
+
+class _WindowStore():
+    """
+    Ring buffers of partial states of recent frames for results over sliding windows,
+    keyed by the task name, aggregate, metahost and class. Frames older than the widest window
+    are evicted, least recently used keys are evicted when there are too many of them
+    """
+
+    def __init__(self, size=_WINDOW_KEYS):
+        self.lock = threading.Lock()
+        self.size = size
+        # key -> deque of (frame end, state) ordered by frame end
+        self.frames = collections.OrderedDict()
+
+    def add(self, key, current, state, width):
+        """Store state of the frame ending at `current`, returns frames within `width` seconds of the newest one"""
+        with self.lock:
+            frames = self.frames.get(key)
+            if frames is None:
+                frames = self.frames[key] = collections.deque()
+                if len(self.frames) > self.size:
+                    self.frames.popitem(last=False)
+            else:
+                self.frames.move_to_end(key)
+
+            if frames and frames[-1][0] >= current:
+                # the same frame sent again replaces the stored one, late frame is put in order
+                ordered = sorted([f for f in frames if f[0] != current] + [(current, state)], key=lambda f: f[0])
+                frames = self.frames[key] = collections.deque(ordered)
+            else:
+                frames.append((current, state))
+            while frames[0][0] <= frames[-1][0] - width:
+                frames.popleft()
+            return list(frames)
+
+
 class Aggregator(aggregator_pb2_grpc.AggregatorServicer):
     """Combaine aggregator custom plugin loader"""
 
-    def __init__(self):
+    def __init__(self, lazy=False):
         self.log = logging.getLogger("combaine")
 
         self.path = os.environ.get('PLUGINS_PATH', '/usr/lib/combaine/custom')
+        # plugins import shared modules (not plugins, names start with `_`) from the plugins path,
+        # such modules are imported once and are not reloaded
+        if self.path not in sys.path:
+            sys.path.append(self.path)
+        # import plugin module on the first request of its class
+        self.lazy = lazy
+        self.lock = threading.Lock()
+        # name -> (file stamp, parsers); import time of module in seconds
+        self.modules = {}
+        self.load_timings = {}
         self.all_custom_parsers = self.load_plugins()
+        self.local = threading.local()
+        self.stats = _Stats()
+        self.profiler = _Profiler()
+        # admission control of plugin calls, requests are not limited without it
+        self.admission = None
+        # partial states of recent frames, windows are disabled without it
+        self.windows = _WindowStore()
+
+    def set_admission(self, concurrency, queue_size):
+        admission = self.admission = _Admission(concurrency, queue_size)
+        self.stats.gauges["admission_queue"] = lambda: len(admission.waiting)
+
+    @contextlib.contextmanager
+    def admit(self, method, class_name, context, size=0):
+        """Run the request when admission control allows, expired requests are rejected up front"""
+        _check_deadline(context)
+        if self.admission is None:
+            yield
+            return
+        with self.admission.admit(method, class_name, context, size):
+            yield
+
+    def start_watcher(self, plugins_reload):
+        if plugins_reload > 0:
+            watcher = threading.Thread(target=self._watch_plugins, args=(plugins_reload, ), daemon=True)
+            watcher.start()
 
     def load_plugins(self):
+        """
+        Import new and changed plugins, unchanged ones are reused
+        and the previous version is kept if the changed one fails to import
+        """
         parsers = {}
+        modules = {}
+        changed = False
         names = set(c.split('.')[0] for c in os.listdir(self.path) if self._is_plugin(c))
         for name in names:
             plugin_file = self.get_plugin_file(name)
@@ -47,19 +569,140 @@ class Aggregator(aggregator_pb2_grpc.AggregatorServicer):
                 self.log.debug("load_plugins skip: %s", name)
                 continue
 
+            stamp = self._file_stamp(plugin_file)
+            previous = self.modules.get(name)
+            if previous is not None and previous[0] == stamp:
+                modules[name] = previous
+                parsers.update(previous[1])
+                continue
+
+            changed = True
+            imported = previous is not None and not self._is_lazy(previous[1])
+            if self.lazy and not imported:
+                candidates = self._scan_plugin(name, plugin_file)
+                if candidates is not None:
+                    modules[name] = (stamp, candidates)
+                    parsers.update(candidates)
+                    continue
             try:
-                spec = importlib.util.spec_from_file_location(name, plugin_file)
-                module = importlib.util.module_from_spec(spec)
-                spec.loader.exec_module(module)
-                self.log.debug("Import parsers from: %s", plugin_file)
-                for item in (x for x in dir(module) if self._is_candidate(x)):
-                    candidate = getattr(module, item)
-                    if callable(candidate):
-                        parsers[item] = candidate
+                candidates = self._import_plugin(name, plugin_file, fresh_copy=imported)
             except Exception as err:
                 self.log.error("ImportError. Module: %s %s", name, repr(err))
+                candidates = previous[1] if previous is not None else {}
+                if candidates:
+                    self.log.error("Keep previous version of %s: %s", name, list(candidates))
+            # failed module is not imported again until its file is changed
+            modules[name] = (stamp, candidates)
+            parsers.update(candidates)
 
-        self.log.info("%s are available custom plugin for parsing", parsers.keys())
+        changed = changed or modules.keys() != self.modules.keys()
+        self.modules = modules
+        for name in set(self.load_timings) - set(modules):
+            del self.load_timings[name]
+        if changed:
+            self.log.info("%s are available custom plugin for parsing", parsers.keys())
+        return parsers
+
+    def reload_plugins(self):
+        """Atomically replace plugins, requests in flight keep classes they already got"""
+        with self.lock:
+            self.all_custom_parsers = self.load_plugins()
+
+    @staticmethod
+    def _is_lazy(parsers):
+        return any(isinstance(p, _LazyPlugin) for p in parsers.values())
+
+    def _scan_plugin(self, name, plugin_file):
+        """
+        Names of candidates defined, assigned or imported at the top level of the plugin source,
+        None if there is no source to scan or names are imported by `*`, such module is imported.
+        Names which are not callable (e.g. constants) are dropped when the module is imported
+        """
+        source = os.path.join(self.path, name + '.py')
+        if not os.path.exists(source):
+            return None
+        try:
+            with open(source, 'rb') as src:
+                tree = ast.parse(src.read(), source)
+        except (OSError, SyntaxError, ValueError) as err:
+            self.log.error("Failed to scan %s: %s", source, repr(err))
+            return None
+
+        names = set()
+        statements = list(tree.body)
+        while statements:
+            node = statements.pop()
+            if isinstance(node, (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)):
+                names.add(node.name)
+            elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+                targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+                for target in targets:
+                    elts = target.elts if isinstance(target, (ast.Tuple, ast.List)) else [target]
+                    names.update(t.id for t in elts if isinstance(t, ast.Name))
+            elif isinstance(node, (ast.Import, ast.ImportFrom)):
+                if any(a.name == '*' for a in node.names):
+                    self.log.debug("%s imports names by *, import it", source)
+                    return None
+                names.update((a.asname or a.name).split('.')[0] for a in node.names)
+            elif isinstance(node, (ast.If, ast.Try, ast.With)):
+                for field in ("body", "orelse", "finalbody", "handlers"):
+                    statements.extend(getattr(node, field, ()))
+            elif isinstance(node, ast.ExceptHandler):
+                statements.extend(node.body)
+        lazy = _LazyPlugin(name, plugin_file)
+        return {item: lazy for item in names if self._is_candidate(item)}
+
+    def _import_lazy(self, name, lazy):
+        """Import module of the lazy plugin and replace all its lazy classes"""
+        with self.lock:
+            if self.all_custom_parsers.get(name) is not lazy:
+                return  # already imported by other request or reloaded
+            try:
+                candidates = self._import_plugin(lazy.module, lazy.plugin_file)
+            except Exception as err:  # pylint: disable=broad-except
+                self.log.error("ImportError. Module: %s %s", lazy.module, repr(err))
+                candidates = {}
+            stamp = self.modules[lazy.module][0]
+            self.modules[lazy.module] = (stamp, candidates)
+            parsers = {k: v for k, v in self.all_custom_parsers.items() if v is not lazy}
+            parsers.update(candidates)
+            self.all_custom_parsers = parsers
+
+    def _watch_plugins(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.reload_plugins()
+            except Exception as err:  # pylint: disable=broad-except
+                self.log.error("Failed to reload plugins: %s", repr(err))
+
+    @staticmethod
+    def _file_stamp(plugin_file):
+        stat = os.stat(plugin_file)
+        return (plugin_file, stat.st_mtime_ns, stat.st_size)
+
+    def _import_plugin(self, name, plugin_file, fresh_copy=False):
+        start = time.time()
+        tmpdir = None
+        if fresh_copy and plugin_file.endswith(tuple(importlib.machinery.EXTENSION_SUFFIXES)):
+            # extension module is not loaded again from the same path, load its copy
+            tmpdir = tempfile.mkdtemp(prefix="combaine-plugin-")
+            plugin_file = shutil.copy(plugin_file, tmpdir)
+        try:
+            spec = importlib.util.spec_from_file_location(name, plugin_file)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        finally:
+            if tmpdir is not None:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+        self.load_timings[name] = time.time() - start
+        self.log.info("Import parsers from: %s (%.3f s)", plugin_file, self.load_timings[name])
+        parsers = {}
+        for item in (x for x in dir(module) if self._is_candidate(x)):
+            candidate = getattr(module, item)
+            if callable(candidate):
+                parsers[item] = candidate
         return parsers
 
     def get_plugin_file(self, name):
@@ -68,11 +711,12 @@ class Aggregator(aggregator_pb2_grpc.AggregatorServicer):
             mod_name = file_base + ext
             if os.path.exists(mod_name):
                 return mod_name
-        # try compiled file
+        # try compiled file, if it is not older than the source
         mod_name = file_base + '.py'
         mod_cache = importlib.util.cache_from_source(mod_name)
         if os.path.exists(mod_cache):
-            return mod_cache
+            if not os.path.exists(mod_name) or os.path.getmtime(mod_cache) >= os.path.getmtime(mod_name):
+                return mod_cache
         if os.path.exists(mod_name):
             return mod_name
         return None
@@ -88,7 +732,10 @@ class Aggregator(aggregator_pb2_grpc.AggregatorServicer):
 
     def getClass(self, logger, name, context):
         klass = self.all_custom_parsers.get(name, None)
-        if not klass:
+        if isinstance(klass, _LazyPlugin):
+            self._import_lazy(name, klass)
+            klass = self.all_custom_parsers.get(name, None)
+        if not klass or isinstance(klass, _LazyPlugin):
             context.set_code(grpc.StatusCode.NOT_FOUND)
             msg = "Class '{}' not found!".format(name)
             context.set_details(msg)
@@ -96,20 +743,166 @@ class Aggregator(aggregator_pb2_grpc.AggregatorServicer):
             raise NameError(msg)
         return klass
 
+    def getMergeableClass(self, logger, name, context):
+        klass = self.getClass(logger, name, context)
+        if not self.is_mergeable(klass):
+            context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+            msg = "Class '{}' does not support partial aggregation!".format(name)
+            context.set_details(msg)
+            logger.error(msg)
+            raise NotImplementedError(msg)
+        return klass
+
+    @staticmethod
+    def is_mergeable(klass):
+        """
+        Optional plugin contract: partial(payload) returns mergeable state,
+        merge(partials) combines states, finalize(state) returns final result.
+        finalize(partial(payload)) must be equal to aggregate_group(payload)
+        and none of them may modify its arguments
+        """
+        return all(callable(getattr(klass, m, None)) for m in ("partial", "merge", "finalize"))
+
+    @staticmethod
+    def is_reusable(klass):
+        """
+        Optional plugin contract: plugin with `reusable = True` keeps no state
+        between calls, so its instance is reused by all requests with the same
+        config. Such plugin must log through `self.log`, it is reassigned on every call
+        """
+        return getattr(klass, "reusable", False) is True
+
+    @staticmethod
+    def is_prepacked(klass):
+        """
+        Optional plugin contract: aggregate_host of plugin with `prepacked = True`
+        returns msgpack encoded bytes, they are sent as is without packing
+        """
+        return getattr(klass, "prepacked", False) is True
+
+    @staticmethod
+    def is_lazy(klass):
+        """
+        Optional plugin contract: partial and merge of plugin with `lazy_payload = True`
+        iterate their argument once, so it may be a generator of results decoded one by one
+        """
+        return getattr(klass, "lazy_payload", False) is True
+
+    def unpack(self, klass, items, timer=None):
+        """
+        Decoded results for partial or merge of the plugin. Lazy plugin gets them decoded
+        as it iterates, so decoded results of all hosts are not kept in memory at once.
+        Time of decoding is the unpack phase of the `timer` if it is given
+        """
+        if timer is not None:
+            decoded = _timed_unpack(items, timer)
+            return decoded if self.is_lazy(klass) else list(decoded)
+        if self.is_lazy(klass):
+            return (msgpack.unpackb(i, raw=False) for i in items)
+        return [msgpack.unpackb(i, raw=False) for i in items]
+
+    def pack(self, result):
+        """Pack result by the Packer of the current thread, its buffer is reused between calls"""
+        packer = getattr(self.local, "packer", None)
+        if packer is None:
+            packer = self.local.packer = msgpack.Packer(autoreset=False)
+        try:
+            packer.pack(result)
+            return packer.bytes()
+        finally:
+            packer.reset()
+
+    def _cache_entry(self, request):
+        """LRU cache entry [config, plugin] of the current thread"""
+        cache = getattr(self.local, "cache", None)
+        if cache is None:
+            cache = self.local.cache = collections.OrderedDict()
+        key = (request.class_name, hashlib.blake2b(request.task.config, digest_size=16).digest())
+        try:
+            entry = cache[key]
+            cache.move_to_end(key)
+        except KeyError:
+            entry = cache[key] = [msgpack.unpackb(request.task.config, raw=False), None]
+            if len(cache) > _PLUGIN_CACHE_SIZE:
+                cache.popitem(last=False)
+        return entry
+
+    def _finalize(self, plugin, cfg, task, class_name, state, method, level=None):
+        """
+        Final result of the partial state of the `level` (type, name), by default the level of the task meta.
+        With `windows: {suffix: seconds}` in config the state is stored by the method and level
+        and results over sliding windows of recent frames are added, names of their metrics
+        are the metric name with the window suffix. Window is added only when frames of the task
+        length cover it, so windows are not undercounted after restart or missed frames.
+        Plugin with `merge_frames(states)` combines states of the frames itself
+        (e.g. averages rates), states of the frames of others are merged as states of hosts.
+        Every server process keeps its own window store, so window covers
+        the frames of the metahost aggregated by this process. Windows are disabled
+        in the pool processes and the supervised workers, as they see a part of frames
+        """
+        result = plugin.finalize(state)
+        windows = cfg.get("windows")
+        if not windows:
+            return result
+        if self.windows is None:
+            cfg['logger'].warning("Windows are disabled for the pool and multiple workers")
+            return result
+        current = task.frame.current
+        length = current - task.frame.previous
+        if not current or length <= 0 or not isinstance(result, dict):
+            cfg['logger'].warning("Windows require the frame of the task and a dict result")
+            return result
+
+        if level is None:
+            level = (task.meta.get("type", ""), task.meta.get("name", ""))
+        key = (method, task.name, task.meta.get("aggregate", ""), task.meta.get("metahost", ""), level, class_name)
+        frames = self.windows.add(key, current, state, max(windows.values()))
+        merge = getattr(plugin, "merge_frames", plugin.merge)
+        for suffix, seconds in windows.items():
+            states = [st for end, st in frames if current - seconds < end <= current]
+            if len(states) < math.ceil(seconds / length):
+                cfg['logger'].debug("Window %s is not covered yet: %d frames", suffix, len(states))
+                continue
+            for name, value in plugin.finalize(merge(states)).items():
+                result[name + suffix] = value
+        return result
+
     def getConfig(self, request):
-        cfg = msgpack.unpackb(request.task.config, raw=False)
+        cfg = dict(self._cache_entry(request)[0])
         logger = RidAdapter(self.log, {'rid': request.task.id, "klass": request.class_name})
         cfg['logger'] = logger
         return cfg
 
+    def getPlugin(self, request, klass, cfg):
+        """New plugin instance or cached one if it is reusable"""
+        if not self.is_reusable(klass):
+            return klass(cfg)
+        entry = self._cache_entry(request)
+        plugin = entry[1]
+        if type(plugin) is not klass:  # pylint: disable=unidiomatic-typecheck
+            plugin = entry[1] = klass(cfg)
+        plugin.log = cfg['logger']
+        return plugin
+
     def Ping(self, request, context):
         return aggregator_pb2.PongResponse()
 
+    def Stats(self, request, context):
+        stats = self.stats.snapshot(request.reset)
+        stats["load_timings"] = dict(self.load_timings)
+        return aggregator_pb2.StatsResponse(stats=json.dumps(stats))
+
+    def Profile(self, request, context):
+        report = self.profiler.configure(request.class_name, request.sample_every or 1)
+        return aggregator_pb2.ProfileResponse(report=report)
+
+    @_admitted
     def AggregateHost(self, request, context):
         """
         Gets the result of a single host,
         performs parsing and their aggregation
         """
+        timer = _Timer(self.stats, "AggregateHost", request.class_name)
         cfg = self.getConfig(request)
         logger = cfg['logger']
 
@@ -118,49 +911,726 @@ class Aggregator(aggregator_pb2_grpc.AggregatorServicer):
         prevtime = request.task.frame.previous
         currtime = request.task.frame.current
         hostname = request.task.meta.get("host")
-        result = klass(cfg).aggregate_host(request.payload, prevtime, currtime, hostname)
+        plugin = self.getPlugin(request, klass, cfg)
+        timer.mark("config")
+        with self.profiler.profile(request.class_name):
+            result = plugin.aggregate_host(request.payload, prevtime, currtime, hostname)
+        timer.mark("plugin")
         cfg['logger'] = None
+        _check_deadline(context)
 
         if cfg.get("logHostResult", False):
             logger.info("Aggregate host result %s: %s", request.task.meta, result)
 
-        result_bytes = msgpack.packb(result)
+        result_bytes = result if self.is_prepacked(klass) else self.pack(result)
+        timer.mark("pack")
+        timer.size("payload", len(request.payload))
+        timer.size("result", len(result_bytes))
+        timer.done()
         return aggregator_pb2.AggregateHostResponse(result=result_bytes)
 
+    @_admitted
     def AggregateGroup(self, request, context):
         """
         Receives a list of results from the aggregate_host,
         and performs aggregation by group
         """
+        timer = _Timer(self.stats, "AggregateGroup", request.class_name)
         cfg = self.getConfig(request)
         logger = cfg['logger']
         klass = self.getClass(logger, request.class_name, context)
-        payload = [msgpack.unpackb(i, raw=False) for i in request.payload]
-        result = klass(cfg).aggregate_group(payload)
+        plugin = self.getPlugin(request, klass, cfg)
+        timer.mark("config")
+        mergeable = bool(request.payload) and self.is_mergeable(klass)
+        # lazy payload is decoded while the plugin merges it,
+        # time of decoding is taken out of the plugin phase in to the unpack one
+        if mergeable:
+            payload = self.unpack(klass, request.payload, timer)
+        else:
+            payload = list(_timed_unpack(request.payload, timer))
+        _check_deadline(context)
+        with self.profiler.profile(request.class_name):
+            if mergeable:
+                # the same as aggregate_group, but may be stopped between merge and finalize
+                state = plugin.partial(payload)
+                _check_deadline(context)
+                result = self._finalize(plugin, cfg, request.task, request.class_name, state, "AggregateGroup")
+            else:
+                result = plugin.aggregate_group(payload)
+        timer.mark("plugin")
+        cfg['logger'] = None
+        _check_deadline(context)
+
+        if cfg.get("logGroupResult", False):
+            logger.info("Aggregate group result %s: %s", request.task.meta, result)
+        result_bytes = self.pack(result)
+        timer.mark("pack")
+        timer.size("payload", sum(map(len, request.payload)))
+        timer.size("result", len(result_bytes))
+        timer.done()
+        return aggregator_pb2.AggregateGroupResponse(result=result_bytes)
+
+    def AggregateGroupStream(self, request_iterator, context):
+        """
+        Receives results from the aggregate_host one or few per message
+        and folds them in to the plugin partial state by batches,
+        so decoded results of all hosts are never kept in memory at once.
+        Not mergeable plugins get the whole group as AggregateGroup does.
+        Messages are read from the client without an admission slot, so a slow client
+        does not hold it, every merge step and the finalize are admitted separately
+        """
+        first = _first_chunk(request_iterator, context)
+        timer = _Timer(self.stats, "AggregateGroupStream", first.class_name)
+        cfg = self.getConfig(first)
+        logger = cfg['logger']
+        klass = self.getClass(logger, first.class_name, context)
+        plugin = self.getPlugin(first, klass, cfg)
+        timer.mark("config")
+        # plugin calls and decoding are nested in to the stream phase, the rest of it is reading of the stream
+        sizes = []
+        items = _stream_payload(first, request_iterator)
+        with self.profiler.profile(first.class_name):
+            if self.is_mergeable(klass):
+                state = None
+                for batch in _batches(items, _STREAM_BATCH):
+                    sizes.append(sum(map(len, batch)))
+                    with self.admit("AggregateGroupStream", first.class_name, context, sizes[-1]):
+                        with timer.measure("plugin"):
+                            partial = plugin.partial(self.unpack(klass, batch, timer))
+                            state = partial if state is None else plugin.merge([state, partial])
+                with self.admit("AggregateGroupStream", first.class_name, context):
+                    with timer.measure("plugin"):
+                        if state is None:
+                            result = plugin.aggregate_group([])
+                        else:
+                            result = self._finalize(plugin, cfg, first.task, first.class_name, state,
+                                                    "AggregateGroupStream")
+            else:
+                items = list(items)
+                sizes.append(sum(map(len, items)))
+                with self.admit("AggregateGroupStream", first.class_name, context, sizes[-1]):
+                    with timer.measure("plugin"):
+                        result = plugin.aggregate_group(list(_timed_unpack(items, timer)))
+        # decoding is measured within the plugin calls
+        timer.nested["plugin"] -= timer.nested["unpack"]
+        timer.mark("stream")
+        cfg['logger'] = None
+
+        if cfg.get("logGroupResult", False):
+            logger.info("Aggregate group result %s: %s", first.task.meta, result)
+        result_bytes = self.pack(result)
+        timer.mark("pack")
+        timer.size("payload", sum(sizes))
+        timer.size("result", len(result_bytes))
+        timer.done()
+        return aggregator_pb2.AggregateGroupResponse(result=result_bytes)
+
+    @_admitted
+    def AggregatePartial(self, request, context):
+        """
+        Receives a list of results from the aggregate_host,
+        and merges them in to the plugin partial state
+        """
+        timer = _Timer(self.stats, "AggregatePartial", request.class_name)
+        cfg = self.getConfig(request)
+        logger = cfg['logger']
+        klass = self.getMergeableClass(logger, request.class_name, context)
+        plugin = self.getPlugin(request, klass, cfg)
+        timer.mark("config")
+        payload = self.unpack(klass, request.payload, timer)
+        _check_deadline(context)
+        with self.profiler.profile(request.class_name):
+            result = plugin.partial(payload)
+        timer.mark("plugin")
+        cfg['logger'] = None
+
+        result_bytes = self.pack(result)
+        timer.mark("pack")
+        timer.size("payload", sum(map(len, request.payload)))
+        timer.size("result", len(result_bytes))
+        timer.done()
+        return aggregator_pb2.AggregateGroupResponse(result=result_bytes)
+
+    @_admitted
+    def AggregateFinalize(self, request, context):
+        """
+        Receives a list of partial states from the AggregatePartial,
+        merges them and performs final aggregation
+        """
+        timer = _Timer(self.stats, "AggregateFinalize", request.class_name)
+        cfg = self.getConfig(request)
+        logger = cfg['logger']
+        klass = self.getMergeableClass(logger, request.class_name, context)
+        plugin = self.getPlugin(request, klass, cfg)
+        timer.mark("config")
+        partials = self.unpack(klass, request.payload, timer)
+        _check_deadline(context)
+        with self.profiler.profile(request.class_name):
+            state = plugin.merge(partials)
+            _check_deadline(context)
+            result = self._finalize(plugin, cfg, request.task, request.class_name, state, "AggregateFinalize")
+        timer.mark("plugin")
         cfg['logger'] = None
 
         if cfg.get("logGroupResult", False):
             logger.info("Aggregate group result %s: %s", request.task.meta, result)
-        result_bytes = msgpack.packb(result)
+        result_bytes = self.pack(result)
+        timer.mark("pack")
+        timer.size("payload", sum(map(len, request.payload)))
+        timer.size("result", len(result_bytes))
+        timer.done()
+        return aggregator_pb2.AggregateGroupResponse(result=result_bytes)
+
+    @_admitted
+    def MergePartials(self, request, context):
+        """Merges partial states, the result is the partial state too"""
+        timer = _Timer(self.stats, "MergePartials", request.class_name)
+        cfg = self.getConfig(request)
+        logger = cfg['logger']
+        klass = self.getMergeableClass(logger, request.class_name, context)
+        plugin = self.getPlugin(request, klass, cfg)
+        timer.mark("config")
+        partials = self.unpack(klass, request.payload, timer)
+        _check_deadline(context)
+        with self.profiler.profile(request.class_name):
+            result = plugin.merge(partials)
+        timer.mark("plugin")
+        cfg['logger'] = None
+
+        result_bytes = self.pack(result)
+        timer.mark("pack")
+        timer.size("payload", sum(map(len, request.payload)))
+        timer.size("result", len(result_bytes))
+        timer.done()
         return aggregator_pb2.AggregateGroupResponse(result=result_bytes)
 
+    @_admitted
+    def AggregateHierarchy(self, request, context):
+        """
+        Receives results from the aggregate_host grouped by subgroups,
+        unpacks each of them once and performs aggregation by host,
+        by subgroup (datacenter) and by the whole metahost in one call
+        """
+        timer = _Timer(self.stats, "AggregateHierarchy", request.class_name)
+        cfg = self.getConfig(request)
+        logger = cfg['logger']
+        klass = self.getClass(logger, request.class_name, context)
+        mergeable = self.is_mergeable(klass)
+        plugin = self.getPlugin(request, klass, cfg) if mergeable else None
+        timer.mark("config")
+        # decoding and packing of every level are nested in to the plugin phase
+        with self.profiler.profile(request.class_name):
+            if mergeable:
+                results = self._aggregate_hierarchy_partials(plugin, cfg, request, context, timer)
+            else:
+                results = self._aggregate_hierarchy(klass, cfg, request, context, timer)
+        timer.mark("plugin")
+        cfg['logger'] = None
+        timer.size("payload", sum(len(item) for group in request.groups for item in group.payload))
+        timer.size("result", sum(len(result.result) for result in results))
+        timer.done()
+        return aggregator_pb2.AggregateHierarchyResponse(results=results)
+
+    def _aggregate_hierarchy(self, klass, cfg, request, context, timer):
+        """
+        Plugin without partial and merge may modify its payload,
+        so every level gets the payload decoded again
+        """
+        def aggregate_group(payload):
+            return self.getPlugin(request, klass, cfg).aggregate_group(list(_timed_unpack(payload, timer)))
+
+        results = []
+        metahost_payload = []
+        for group in request.groups:
+            _check_deadline(context)
+            if request.per_host:
+                for host, item in zip(group.hosts, group.payload):
+                    results.append(self._aggregate_level(cfg, request, "host", host, aggregate_group, [item], timer))
+            if group.payload and not request.skip_per_datacenter:
+                results.append(self._aggregate_level(cfg, request, "datacenter", group.name, aggregate_group,
+                                                     group.payload, timer))
+            metahost_payload.extend(group.payload)
+
+        if metahost_payload:
+            _check_deadline(context)
+            metahost = request.task.meta.get("metahost", "")
+            results.append(self._aggregate_level(cfg, request, "metahost", metahost, aggregate_group, metahost_payload,
+                                                 timer))
+        return results
+
+    def _aggregate_hierarchy_partials(self, plugin, cfg, request, context, timer):
+        """Datacenter partial states are reused to build the metahost result"""
+        logger = cfg['logger']
+        results = []
+        partials = []
+        metahost_error = None
+        for group in request.groups:
+            _check_deadline(context)
+            if not group.payload:
+                continue
+            if request.per_host:
+                payload = list(_timed_unpack(group.payload, timer))
+                for host, item in zip(group.hosts, payload):
+                    results.append(self._aggregate_level(cfg, request, "host", host, plugin.aggregate_group, [item],
+                                                         timer))
+            else:
+                payload = self.unpack(type(plugin), group.payload, timer)
+            try:
+                state = plugin.partial(payload)
+            except Exception as err:  # pylint: disable=broad-except
+                logger.error("Failed to merge datacenter %s: %s", group.name, err)
+                metahost_error = err
+                if not request.skip_per_datacenter:
+                    results.append(self._level_error(request, "datacenter", group.name, err))
+                continue
+            partials.append(state)
+            if not request.skip_per_datacenter:
+                results.append(self._aggregate_level(cfg, request, "datacenter", group.name, plugin.finalize, state,
+                                                     timer))
+
+        metahost = request.task.meta.get("metahost", "")
+        if metahost_error is not None:
+            results.append(self._level_error(request, "metahost", metahost, metahost_error))
+        elif partials:
+            _check_deadline(context)
+
+            def finalize(partials):
+                return self._finalize(plugin, cfg, request.task, request.class_name, plugin.merge(partials),
+                                      "AggregateHierarchy", ("metahost", metahost))
+
+            results.append(self._aggregate_level(cfg, request, "metahost", metahost, finalize, partials, timer))
+        return results
+
+    @staticmethod
+    def _level_meta(request, level, name):
+        meta = dict(request.task.meta)
+        meta["type"] = level
+        meta["name"] = name
+        return meta
+
+    def _level_error(self, request, level, name, err):
+        meta = self._level_meta(request, level, name)
+        return aggregator_pb2.AggregateResult(meta=meta, error=repr(err))
+
+    def _aggregate_level(self, cfg, request, level, name, aggregate, payload, timer):
+        logger = cfg['logger']
+        try:
+            result = aggregate(payload)
+        except Exception as err:  # pylint: disable=broad-except
+            logger.error("Failed to aggregate %s %s: %s", level, name, err)
+            return self._level_error(request, level, name, err)
+
+        meta = self._level_meta(request, level, name)
+        if cfg.get("logGroupResult", False):
+            logger.info("Aggregate %s result %s: %s", level, meta, result)
+        with timer.measure("pack"):
+            result_bytes = self.pack(result)
+        return aggregator_pb2.AggregateResult(meta=meta, result=result_bytes)
+
+
+_pool_servicer = None
+_preloaded_servicer = None
+
+
+class _PoolContext():
+    """Collects the status set by the servicer in a pool process, deadline is the unix time"""
+
+    def __init__(self, deadline=None):
+        self.code = None
+        self.details = None
+        self.deadline = deadline
+
+    def time_remaining(self):
+        return None if self.deadline is None else self.deadline - time.time()
+
+    def is_active(self):  # pylint: disable=no-self-use
+        return True
+
+    def set_code(self, code):
+        self.code = code
+
+    def set_details(self, details):
+        self.details = details
+
+
+def _init_pool_process(logoutput, loglevel, plugins_reload, plugins_lazy):
+    """Load plugins once per pool process"""
+    global _pool_servicer  # pylint: disable=global-statement
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    prctl.set_pdeathsig(signal.SIGTERM)
+    if logoutput:
+        _setup_logging(logoutput, loglevel)
+    _pool_servicer = Aggregator(plugins_lazy)
+    # calls are spread over the pool processes, none of them sees all frames of a window
+    _pool_servicer.windows = None
+    _pool_servicer.start_watcher(plugins_reload)
+
+
+def _pool_execute(method, request_bytes, profile=False, deadline=None):
+    """
+    Run servicer method in a pool process. Request and response are passed
+    serialized, so decoded payloads never cross the process boundary.
+    Stats, profile of the call and import timings of plugins are returned to be merged by the server
+    """
+    request_type = getattr(aggregator_pb2, _OFFLOADED_METHODS[method])
+    request = request_type.FromString(request_bytes)
+    context = _PoolContext(deadline)
+    # pool process runs one call at a time
+    stats = _pool_servicer.stats = _Stats()
+    profiler = _pool_servicer.profiler = _Profiler()
+    if profile:
+        profiler.configure(request.class_name, 1)
+    try:
+        response = getattr(_pool_servicer, method)(request, context)
+    except Exception as err:  # pylint: disable=broad-except
+        return (None, context.code, context.details or repr(err), stats.export(), profiler.raw_stats(),
+                dict(_pool_servicer.load_timings))
+    return (response.SerializeToString(), None, None, stats.export(), profiler.raw_stats(),
+            dict(_pool_servicer.load_timings))
+
+
+_OFFLOADED_METHODS = {
+    "AggregateHost": "AggregateHostRequest",
+    "AggregateGroup": "AggregateGroupRequest",
+    "AggregatePartial": "AggregateGroupRequest",
+    "AggregateFinalize": "AggregateGroupRequest",
+    "MergePartials": "AggregateGroupRequest",
+    "AggregateHierarchy": "AggregateHierarchyRequest",
+}
+
+
+class PoolAggregator(aggregator_pb2_grpc.AggregatorServicer):
+    """
+    Aggregator which runs plugins in the pool of processes,
+    gRPC threads only receive requests and send responses
+    """
+
+    def __init__(self, processes, queue_size, logoutput=None, loglevel="INFO", plugins_reload=0, plugins_lazy=False):
+        self.log = logging.getLogger("combaine")
+        self.processes = processes
+        self.initargs = (logoutput, loglevel, plugins_reload, plugins_lazy)
+        # requests running or waiting for the pool, the rest are rejected
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.busy = 0
+        self.lock = threading.Lock()
+        self.pool = self._new_pool()
+        self.stats = _Stats()
+        self.stats.gauges["pool_queue"] = lambda: self.busy
+        self.profiler = _Profiler()
+        # import time of plugin modules in seconds reported by the last call of the pool processes
+        self.load_timings = {}
+
+    def _new_pool(self):
+        # forkserver: pool processes must not be forked from the process with running gRPC server
+        ctx = multiprocessing.get_context("forkserver")
+        pool = futures.ProcessPoolExecutor(max_workers=self.processes, mp_context=ctx,
+                                           initializer=_init_pool_process, initargs=self.initargs)
+        # start processes and load plugins before the first request
+        futures.wait([pool.submit(time.sleep, 0) for _ in range(self.processes)])
+        return pool
+
+    def _restart_pool(self, broken):
+        with self.lock:
+            if self.pool is broken:
+                self.log.error("Process pool is broken, restart it")
+                self.pool = self._new_pool()
+
+    def _acquire(self, count, context):
+        """Acquire up to count queue slots, requests are rejected if there is no one"""
+        acquired = 0
+        while acquired < count and self.slots.acquire(blocking=False):
+            acquired += 1
+        if not acquired:
+            context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+            msg = "Aggregator queue is full"
+            context.set_details(msg)
+            raise RuntimeError(msg)
+        self.busy += acquired  # gauge only, races are harmless
+        return acquired
+
+    def _release(self, count):
+        self.busy -= count
+        for _ in range(count):
+            self.slots.release()
+
+    def _execute(self, method, requests, response_type, context):
+        """Run requests in parallel in the pool"""
+        pool = self.pool
+        remaining = context.time_remaining()
+        deadline = None if remaining is None else time.time() + remaining
+        try:
+            jobs = [pool.submit(_pool_execute, method, request.SerializeToString(),
+                                self.profiler.sampled(request.class_name), deadline) for request in requests]
+            results = [job.result() for job in jobs]
+        except BrokenProcessPool as err:
+            self._restart_pool(pool)
+            context.set_code(grpc.StatusCode.UNAVAILABLE)
+            context.set_details(repr(err))
+            raise
+
+        for _, _, _, stats, profile, load_timings in results:
+            self.stats.merge(stats)
+            if profile is not None:
+                self.profiler.add(_RawProfile(profile))
+            self.load_timings.update(load_timings)
+
+        responses = []
+        for result, code, details, _, _, _ in results:
+            if result is None:
+                context.set_code(code or grpc.StatusCode.UNKNOWN)
+                context.set_details(details)
+                raise RuntimeError(details)
+            responses.append(response_type.FromString(result))
+        return responses
+
+    def _offload(self, method, request, response_type, context):
+        _check_deadline(context)
+        self._acquire(1, context)
+        try:
+            return self._execute(method, [request], response_type, context)[0]
+        finally:
+            self._release(1)
+
+    def Ping(self, request, context):
+        return aggregator_pb2.PongResponse()
+
+    def Stats(self, request, context):
+        stats = self.stats.snapshot(request.reset)
+        stats["load_timings"] = dict(self.load_timings)
+        return aggregator_pb2.StatsResponse(stats=json.dumps(stats))
+
+    def Profile(self, request, context):
+        report = self.profiler.configure(request.class_name, request.sample_every or 1)
+        return aggregator_pb2.ProfileResponse(report=report)
+
+    def AggregateHost(self, request, context):
+        return self._offload("AggregateHost", request, aggregator_pb2.AggregateHostResponse, context)
+
+    def AggregateGroup(self, request, context):
+        return self._offload("AggregateGroup", request, aggregator_pb2.AggregateGroupResponse, context)
+
+    def AggregateGroupStream(self, request_iterator, context):
+        """
+        Batches of the streamed group are merged in to partial states by the pool,
+        only serialized partial states are kept in this process
+        """
+        first = _first_chunk(request_iterator, context)
+
+        def group_request(payload):
+            return aggregator_pb2.AggregateGroupRequest(task=first.task, class_name=first.class_name,
+                                                        payload=payload)
+
+        response_type = aggregator_pb2.AggregateGroupResponse
+        payload = _stream_payload(first, request_iterator)
+        batch = list(itertools.islice(payload, _STREAM_BATCH))
+        if not batch:
+            return self._offload("AggregateGroup", group_request(batch), response_type, context)
+
+        remaining = context.time_remaining()
+        probe = _PoolContext(None if remaining is None else time.time() + remaining)
+        try:
+            partials = [self._offload("AggregatePartial", group_request(batch), response_type, probe).result]
+        except Exception:
+            if probe.code != grpc.StatusCode.UNIMPLEMENTED:
+                context.set_code(probe.code or grpc.StatusCode.UNKNOWN)
+                context.set_details(probe.details)
+                raise
+            # plugin is not mergeable, it gets the whole group at once
+            batch.extend(payload)
+            return self._offload("AggregateGroup", group_request(batch), response_type, context)
+
+        for batch in _batches(payload, _STREAM_BATCH):
+            partials.append(self._offload("AggregatePartial", group_request(batch), response_type, context).result)
+            if len(partials) >= _STREAM_BATCH:
+                partials = [self._offload("MergePartials", group_request(partials), response_type, context).result]
+        return self._offload("AggregateFinalize", group_request(partials), response_type, context)
+
+    def AggregatePartial(self, request, context):
+        return self._offload("AggregatePartial", request, aggregator_pb2.AggregateGroupResponse, context)
+
+    def AggregateFinalize(self, request, context):
+        return self._offload("AggregateFinalize", request, aggregator_pb2.AggregateGroupResponse, context)
+
+    def MergePartials(self, request, context):
+        return self._offload("MergePartials", request, aggregator_pb2.AggregateGroupResponse, context)
+
+    def AggregateHierarchy(self, request, context):
+        return self._offload("AggregateHierarchy", request, aggregator_pb2.AggregateHierarchyResponse, context)
+
+
+class _RequestCounter(grpc.ServerInterceptor):
+    """Counts requests accepted by the server, tracks in-flight requests and their latency"""
+
+    def __init__(self, stats=None, capture=None):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.stats = stats
+        self.capture = capture
+
+    def intercept_service(self, continuation, handler_call_details):
+        with self.lock:
+            self.count += 1
+        handler = continuation(handler_call_details)
+        if handler is None or self.stats is None:
+            return handler
+        method = handler_call_details.method.rsplit('/', 1)[-1]
+        if handler.unary_unary is not None:
+            return handler._replace(unary_unary=self._track(method, handler.unary_unary))
+        if handler.stream_unary is not None:
+            return handler._replace(stream_unary=self._track(method, handler.stream_unary, streaming=True))
+        return handler
+
+    def _track(self, method, behavior, streaming=False):
+        def tracked(request, context):
+            self.stats.begin()
+            record = None
+            if self.capture is not None:
+                request, record = self.capture.track(method, request, streaming)
+            start = time.perf_counter()
+            failed = True
+            error = None
+            try:
+                response = behavior(request, context)
+                failed = False
+                return response
+            except Exception as err:
+                error = str(err)
+                raise
+            finally:
+                duration = time.perf_counter() - start
+                self.stats.end(method, duration, failed)
+                if record is not None:
+                    self.capture.write(record, duration, error)
+
+        return tracked
+
+
+class _ExecutorContext(_PoolContext):
+    """Context of the servicer method running in the executor thread, collects its status"""
+
+    def __init__(self, context):
+        remaining = context.time_remaining()
+        super().__init__(None if remaining is None else time.time() + remaining)
+        self.context = context
+
+    def is_active(self):
+        return not self.context.done()
+
+
+class _AioServicer(aggregator_pb2_grpc.AggregatorServicer):
+    """
+    grpc.aio adapter of the sync servicer: transport and cheap methods
+    are served by the event loop, plugin calls run in the executor threads
+    """
+
+    def __init__(self, servicer, executor, capture=None):
+        self.servicer = servicer
+        self.executor = executor
+        self.stats = servicer.stats
+        self.capture = capture
+        # requests accepted by the server
+        self.count = 0
+
+    async def _call(self, method, request, context, inline=False, streaming=False):
+        self.count += 1
+        self.stats.begin()
+        record = None
+        if self.capture is not None:
+            request, record = self.capture.track(method, request, streaming)
+        start = time.perf_counter()
+        failed = True
+        error = None
+        call_context = _ExecutorContext(context)
+        try:
+            behavior = getattr(self.servicer, method)
+            if inline:
+                response = behavior(request, call_context)
+            else:
+                loop = asyncio.get_event_loop()
+                response = await loop.run_in_executor(self.executor, behavior, request, call_context)
+            failed = False
+            return response
+        except Exception as err:  # pylint: disable=broad-except
+            error = str(err)
+            await context.abort(call_context.code or grpc.StatusCode.UNKNOWN, call_context.details or repr(err))
+        finally:
+            duration = time.perf_counter() - start
+            self.stats.end(method, duration, failed)
+            if record is not None:
+                self.capture.write(record, duration, error)
+
+    async def Ping(self, request, context):
+        return await self._call("Ping", request, context, inline=True)
+
+    async def Stats(self, request, context):
+        return await self._call("Stats", request, context, inline=True)
+
+    async def Profile(self, request, context):
+        return await self._call("Profile", request, context, inline=True)
+
+    async def AggregateHost(self, request, context):
+        return await self._call("AggregateHost", request, context)
+
+    async def AggregateGroup(self, request, context):
+        return await self._call("AggregateGroup", request, context)
+
+    async def AggregateGroupStream(self, request_iterator, context):
+        """Executor thread reads messages of the stream from the event loop as it needs them"""
+        loop = asyncio.get_event_loop()
+
+        def chunks():
+            while True:
+                try:
+                    yield asyncio.run_coroutine_threadsafe(request_iterator.__anext__(), loop).result()
+                except StopAsyncIteration:
+                    return
+
+        return await self._call("AggregateGroupStream", chunks(), context, streaming=True)
+
+    async def AggregatePartial(self, request, context):
+        return await self._call("AggregatePartial", request, context)
+
+    async def AggregateFinalize(self, request, context):
+        return await self._call("AggregateFinalize", request, context)
+
+    async def MergePartials(self, request, context):
+        return await self._call("MergePartials", request, context)
+
+    async def AggregateHierarchy(self, request, context):
+        return await self._call("AggregateHierarchy", request, context)
+
+
+def _current_rss():
+    """Resident set size of the current process in bytes"""
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
 
 @contextlib.contextmanager
-def _reserve_port():
+def _reserve_port(bind_address):
     """Reserve a port for all subprocesses to use."""
-    sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    host, _, port = bind_address.rpartition(':')
+    host = host.strip('[]') or '::'
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     if sock.getsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT) != 1:
         raise RuntimeError("Failed to set SO_REUSEPORT.")
-    sock.bind(('', 10000))
+    sock.bind((host, int(port)))
     try:
         yield sock.getsockname()[1]
     finally:
         sock.close()
 
 
-def _run_server(bind_address):
-    """Start a server in a subprocess."""
+def _run_server(bind_address, pool_processes=0, pool_queue=0, logoutput=None, loglevel="INFO",
+                max_requests=0, max_rss=0, plugins_reload=0, plugins_lazy=False, concurrency=4, admission_queue=0,
+                aio=False, capture=None, capture_sample=1.0, capture_max_bytes=0, capture_backups=3, recycling=None,
+                windows=True):
+    """
+    Start a server in a subprocess. `recycling` event is set when the server
+    starts to recycle, so the supervisor may start its replacement at once.
+    Sliding windows are kept unless `windows` is false
+    """
     prctl.set_pdeathsig(signal.SIGTERM)
     logging.info('Starting new server.')
     options = (
@@ -175,54 +1645,99 @@ def _run_server(bind_address):
     # advantage of this feature, install from source with
     # `pip install grpcio --no-binary grpcio`.
 
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4), options=options)
-    aggregator_pb2_grpc.add_AggregatorServicer_to_server(Aggregator(), server)
-    server.add_insecure_port(bind_address)
-    server.start()
-    _wait_forever(server)
+    if pool_processes > 0:
+        pool_queue = max(pool_queue, pool_processes)
+        servicer = PoolAggregator(pool_processes, pool_queue, logoutput, loglevel, plugins_reload, plugins_lazy)
+        # threads only wait for the pool, one thread per queue slot
+        # and few more to reject requests when the queue is full
+        max_workers = pool_queue + 4
+    else:
+        # plugins imported by the supervisor are shared with workers by copy-on-write
+        servicer = _preloaded_servicer if _preloaded_servicer is not None else Aggregator(plugins_lazy)
+        if not windows:
+            servicer.windows = None
+        servicer.start_watcher(plugins_reload)
+        max_workers = concurrency
+        if admission_queue > 0:
+            servicer.set_admission(concurrency, admission_queue)
+            # queued requests wait in the gRPC threads, few more threads
+            # serve Ping and Stats and reject requests when the queue is full
+            max_workers = concurrency + admission_queue + 4
+    if capture:
+        # every server process writes its own file
+        capture = _Capture("{}.{}".format(capture, os.getpid()), capture_sample, capture_max_bytes, capture_backups)
+    if aio:
+        asyncio.run(_serve_aio(bind_address, servicer, max_workers, options, max_requests, max_rss, capture,
+                               recycling))
+    else:
+        counter = _RequestCounter(servicer.stats, capture)
+        executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+        servicer.stats.gauges["grpc_queue"] = executor._work_queue.qsize  # pylint: disable=protected-access
+        server = grpc.server(executor, interceptors=(counter, ), options=options)
+        aggregator_pb2_grpc.add_AggregatorServicer_to_server(servicer, server)
+        server.add_insecure_port(bind_address)
+        server.start()
+        _wait_forever(server, counter, max_requests, max_rss, recycling)
+    if pool_processes > 0:
+        # pool processes are not daemons, the server process waits for them on exit
+        servicer.pool.shutdown()
 
 
-def _wait_forever(server):
+def _wait_forever(server, counter, max_requests=0, max_rss=0, recycling=None):
+    """Serve until interrupted or until the server needs to be recycled"""
     try:
         while True:
-            time.sleep(60 * 60 * 24)
+            time.sleep(_RECYCLE_CHECK_INTERVAL)
+            if max_requests and counter.count >= max_requests:
+                logging.info("Recycle server after %d requests", counter.count)
+                break
+            if max_rss and _current_rss() >= max_rss:
+                logging.info("Recycle server with RSS %d Mb", _current_rss() // 1024 // 1024)
+                break
+        # in-flight requests are completed, new ones go to other servers on the same port
+        if recycling is not None:
+            recycling.set()
+        server.stop(_RECYCLE_GRACE).wait()
     except KeyboardInterrupt:
         server.stop(0)
 
 
-def serve():
-    with _reserve_port() as port:
-        bind_address = '[::]:{}'.format(port)
-        logging.info("Binding to '%s'", bind_address)
-        workers = []
-        for _ in range(_PROCESS_COUNT):
-            # NOTE: It is imperative that the worker subprocesses be forked before
-            # any gRPC servers start up. See
-            # https://github.com/grpc/grpc/issues/16001 for more details.
-            worker = multiprocessing.Process(target=_run_server, args=(bind_address, ))
-            workers.append(worker)
-        for worker in workers:
-            worker.daemon = True
-            worker.start()
-        while True:
-            for worker in workers:
-                worker.join(1)
-                if worker.exitcode:
-                    logging.error("worker exit by %s", worker.exitcode)
-                    raise RuntimeError("Some worker disappear")
+async def _serve_aio(bind_address, servicer, max_workers, options, max_requests=0, max_rss=0, capture=None,
+                     recycling=None):
+    """
+    Serve by grpc.aio server until SIGINT or SIGTERM or until the server needs to be recycled,
+    then new requests are rejected and in-flight ones are completed
+    """
+    executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+    servicer.stats.gauges["grpc_queue"] = executor._work_queue.qsize  # pylint: disable=protected-access
+    adapter = _AioServicer(servicer, executor, capture)
+    server = grpc.aio.server(options=options)
+    aggregator_pb2_grpc.add_AggregatorServicer_to_server(adapter, server)
+    server.add_insecure_port(bind_address)
+    await server.start()
 
+    stopped = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopped.set)
+    while not stopped.is_set():
+        try:
+            await asyncio.wait_for(stopped.wait(), _RECYCLE_CHECK_INTERVAL)
+            logging.info("Stop server, wait for %d in-flight requests", adapter.stats.in_flight)
+        except asyncio.TimeoutError:
+            if max_requests and adapter.count >= max_requests:
+                logging.info("Recycle server after %d requests", adapter.count)
+                break
+            if max_rss and _current_rss() >= max_rss:
+                logging.info("Recycle server with RSS %d Mb", _current_rss() // 1024 // 1024)
+                break
+    if recycling is not None and not stopped.is_set():
+        recycling.set()
+    await server.stop(_RECYCLE_GRACE)
+    executor.shutdown(wait=True)
 
-if __name__ == '__main__':
-
-    parser = argparse.ArgumentParser(description='Combaine aggregator.py')
-    parser.add_argument('--endpoint', help="Listen addr")
-    parser.add_argument('--logoutput', help="Logging output (enpoint port will be added at the end of file)")
-    parser.add_argument('--loglevel', help="Logging level", default="INFO")
-    args = parser.parse_args()
-
-    port = args.endpoint.split(":")[-1]
-    logoutput = args.logoutput.replace(".log", "." + port) + ".log"
 
+def _setup_logging(logoutput, loglevel):
     root = logging.getLogger()
     maxSize = 512 * 1024 * 1024  # 0.5 Gb
     h = logging.handlers.RotatingFileHandler(logoutput, 'a', maxSize, 3)
@@ -231,9 +1746,174 @@ if __name__ == '__main__':
     root.addHandler(h)
     logLevel = logging.INFO
     try:
-        logLevel = getattr(logging, args.loglevel.upper())
+        logLevel = getattr(logging, loglevel.upper())
     except:  # noqa pylint: disable=E722
         pass
-    logging.getLogger().setLevel(logLevel)
+    root.setLevel(logLevel)
+
+
+class _Worker():
+    """
+    Server subprocess restarted on exit, with backoff if it crashed.
+    Replacement of the recycled one is started while it completes in-flight requests
+    """
+
+    def __init__(self, bind_address, options):
+        self.bind_address = bind_address
+        self.options = options
+        self.process = None
+        self.recycling = None
+        # recycled processes which complete in-flight requests
+        self.retired = []
+        self.started = 0
+        self.restart_at = 0
+        self.backoff = 0
+
+    def check(self, now):
+        for process in self.retired[:]:
+            if not process.is_alive():
+                process.join()
+                self.retired.remove(process)
+
+        if self.process is None:
+            if now >= self.restart_at:
+                self.start(now)
+            return
+
+        if self.process.is_alive():
+            if self.recycling.is_set():
+                logging.info("worker pid=%d is recycled, start its replacement", self.process.pid)
+                self.retired.append(self.process)
+                self.start(now)
+            elif self.backoff and now - self.started > _BACKOFF_RESET:
+                self.backoff = 0
+            return
+
+        exitcode = self.process.exitcode
+        self.process.join()
+        self.process = None
+        if exitcode == 0:
+            logging.info("worker recycled, restart it")
+            self.start(now)
+        else:
+            self.backoff = min(self.backoff * 2 or 1, _BACKOFF_MAX)
+            logging.error("worker exit by %s, restart in %d s", exitcode, self.backoff)
+            self.restart_at = now + self.backoff
+
+    def start(self, now):
+        # NOTE: It is imperative that the worker subprocesses be forked before
+        # any gRPC servers start up. See
+        # https://github.com/grpc/grpc/issues/16001 for more details.
+        # The supervisor never starts gRPC server, so workers may be restarted.
+        # Workers are not daemons, so they may have pool processes, they are
+        # stopped by `stop` or by the parent death signal if the supervisor is killed
+        self.recycling = multiprocessing.Event()
+        self.process = multiprocessing.Process(target=_run_server, args=(self.bind_address, ),
+                                               kwargs=dict(self.options, recycling=self.recycling))
+        self.process.start()
+        self.started = now
+        logging.info("worker started pid=%d", self.process.pid)
+
+    def stop(self):
+        processes = self.retired + ([self.process] if self.process is not None else [])
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(_RECYCLE_GRACE)
+
+
+def serve(bind_address, workers=1, plugins_preload=False, **options):
+    """
+    Run `workers` server processes on the same port under supervision,
+    options are passed to the _run_server. Single server runs in the current process
+    """
+    global _preloaded_servicer  # pylint: disable=global-statement
+    if workers > 1 or options.get("pool_processes"):
+        logging.warning("Sliding windows are disabled: calls are spread over %s, none of them sees all frames",
+                        "workers" if workers > 1 else "pool processes")
+    if workers <= 1:
+        _run_server(bind_address, **options)
+        return
+    if plugins_preload and not options.get("pool_processes"):
+        # import all plugins once before fork
+        _preloaded_servicer = Aggregator()
+    # SO_REUSEPORT spreads calls over workers, none of them sees all frames of a window
+    options["windows"] = False
+    with _reserve_port(bind_address) as port:
+        bind_address = '{}:{}'.format(bind_address.rpartition(':')[0], port)
+        logging.info("Binding %d workers to '%s'", workers, bind_address)
+        supervised = [_Worker(bind_address, options) for _ in range(workers)]
+        try:
+            while True:
+                now = time.time()
+                for worker in supervised:
+                    worker.check(now)
+                time.sleep(1)
+        finally:
+            for worker in supervised:
+                worker.stop()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Combaine aggregator.py')
+    parser.add_argument('--endpoint', help="Listen addr")
+    parser.add_argument('--logoutput', help="Logging output (enpoint port will be added at the end of file)")
+    parser.add_argument('--loglevel', help="Logging level", default="INFO")
+    parser.add_argument('--pool-processes', type=int, default=0,
+                        help="Run plugins in the pool of N processes (0 - in the gRPC threads)")
+    parser.add_argument('--pool-queue', type=int, default=0,
+                        help="Max requests running or waiting for the pool, the rest are rejected")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of supervised server processes on the endpoint, RSS of them"
+                        " is limited by --max-rss (default - one server in this process)")
+    parser.add_argument('--max-requests', type=int, default=0,
+                        help="Recycle server process after N requests (0 - never)")
+    parser.add_argument('--max-rss', type=int, default=0,
+                        help="Recycle server process when its RSS exceeds N Mb (0 - never)")
+    parser.add_argument('--plugins-reload', type=int, default=0,
+                        help="Check plugins for changes every N seconds and reload them (0 - never)")
+    parser.add_argument('--plugins-lazy', action='store_true',
+                        help="Import plugin module on the first request of its class")
+    parser.add_argument('--plugins-preload', action='store_true',
+                        help="Import all plugins in the supervisor before starting workers")
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="Max plugin calls running at once by the server process without the pool")
+    parser.add_argument('--admission-queue', type=int, default=64,
+                        help="Max requests waiting for a plugin call ordered by priority and deadline,"
+                        " the rest are rejected (0 - no admission control)")
+    parser.add_argument('--aio', action='store_true',
+                        help="Serve by grpc.aio: transport and cheap methods in the event loop,"
+                        " plugin calls in the threads")
+    parser.add_argument('--capture', default=None,
+                        help="Write sampled requests with timings to CAPTURE.<pid> for aggregator/replay.py")
+    parser.add_argument('--capture-sample', type=float, default=0.01,
+                        help="Share of requests to capture")
+    parser.add_argument('--capture-max-size', type=int, default=256,
+                        help="Rotate the capture file when it exceeds N Mb (0 - never)")
+    parser.add_argument('--capture-backups', type=int, default=3,
+                        help="Number of rotated capture files to keep")
+    args = parser.parse_args()
+
+    port = args.endpoint.split(":")[-1]
+    logoutput = args.logoutput.replace(".log", "." + port) + ".log"
+
+    _setup_logging(logoutput, args.loglevel)
     logging.info("Current log level: %s", args.loglevel)
-    _run_server(args.endpoint)
+    serve(args.endpoint, args.workers,
+          pool_processes=args.pool_processes,
+          pool_queue=args.pool_queue or 2 * args.pool_processes,
+          logoutput=logoutput.replace(".log", ".pool.log"),
+          loglevel=args.loglevel,
+          max_requests=args.max_requests,
+          max_rss=args.max_rss * 1024 * 1024,
+          plugins_reload=args.plugins_reload,
+          plugins_lazy=args.plugins_lazy,
+          plugins_preload=args.plugins_preload,
+          concurrency=args.concurrency,
+          admission_queue=args.admission_queue,
+          aio=args.aio,
+          capture=args.capture,
+          capture_sample=args.capture_sample,
+          capture_max_bytes=args.capture_max_size * 1024 * 1024,
+          capture_backups=args.capture_backups)
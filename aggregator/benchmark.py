@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Benchmark of aggregator plugins and the Aggregator servicer on synthetic payloads.
+Results are printed as json, so they can be compared between releases:
+
+    PLUGINS_PATH=plugins/aggregators python3 aggregator/benchmark.py --hosts 100 > bench.json
+"""
+import argparse
+import json
+import logging
+import math
+import platform
+import random
+import time
+from concurrent import futures
+
+import grpc
+import msgpack
+
+import aggregator
+import aggregator_pb2
+import aggregator_pb2_grpc
+
+_GRPC_OPTIONS = (
+    ('grpc.max_send_message_length', 128 * 1024 * 1024),
+    ('grpc.max_receive_message_length', 128 * 1024 * 1024),
+)
+
+PLUGINS = {
+    "Multimetrics": {},
+    "Apdex": {"satisfied": 0.3, "tolerating": 0.9},
+}
+
+
+def generate_payload(rnd, metrics=1000, timings_share=0.1, timings_per_line=50, packed_ratio=0.1):
+    """
+    Payload of one host shaped like testdata/payload/multimetrics.txt:
+    counters `name value`, timings `name_timings value value ...`
+    and packed timings `@name_timings value@count ...`
+    """
+    lines = []
+    for idx in range(metrics):
+        if rnd.random() >= timings_share:
+            lines.append("svc.metric_{}.{}xx {}".format(idx, rnd.randint(2, 5), rnd.randint(0, 100000)))
+        elif rnd.random() < packed_ratio:
+            values = ("{:.3f}@{}".format(rnd.expovariate(10), rnd.randint(1, 100)) for _ in range(timings_per_line))
+            lines.append("@svc.metric_{}_timings {}".format(idx, " ".join(values)))
+        else:
+            values = ("{:.3f}".format(rnd.expovariate(10)) for _ in range(timings_per_line))
+            lines.append("svc.metric_{}_timings {}".format(idx, " ".join(values)))
+    return "\n".join(lines).encode()
+
+
+def measure(name, func, rounds, items=1):
+    """Call func `rounds` times, `items` is the count of processed items (hosts, lines) per call"""
+    func()  # warm up caches and lazy imports
+    latencies = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+
+    def percentile(quant):
+        return latencies[max(0, int(math.ceil(quant / 100.0 * len(latencies))) - 1)]
+
+    mean = sum(latencies) / len(latencies)
+    result = {
+        "name": name,
+        "rounds": rounds,
+        "items": items,
+        "mean_ms": mean * 1000,
+        "p50_ms": percentile(50) * 1000,
+        "p99_ms": percentile(99) * 1000,
+        "ops_per_sec": 1 / mean if mean else None,
+        "items_per_sec": items / mean if mean else None,
+    }
+    logging.info("%s: p50 %.3f ms, p99 %.3f ms", name, result["p50_ms"], result["p99_ms"])
+    return result
+
+
+def bench_plugins(servicer, payloads, rounds):
+    results = []
+    for class_name, config in PLUGINS.items():
+        klass = servicer.all_custom_parsers.get(class_name)
+        if klass is None:
+            logging.warning("Plugin %s not found, skip it", class_name)
+            continue
+        plugin = klass(dict(config, logger=logging.getLogger()))
+        payload = payloads[class_name]
+        lines = payload[0].count(b"\n") + 1
+        results.append(measure(class_name + ".aggregate_host",
+                               lambda: plugin.aggregate_host(payload[0], 1, 61), rounds, lines))
+
+        host_results = [plugin.aggregate_host(item, 1, 61) for item in payload]
+        results.append(measure(class_name + ".aggregate_group",
+                               lambda: plugin.aggregate_group(host_results), rounds, len(host_results)))
+
+        if hasattr(plugin, "calculate_quantiles"):
+            state = plugin.partial(host_results)
+            timings = [value for name, value in state.items() if plugin.is_timings(name)]
+
+            def calculate_quantiles():
+                for value in timings:
+                    plugin.calculate_quantiles(value, sum(value.values()))
+
+            results.append(measure(class_name + ".calculate_quantiles", calculate_quantiles, rounds, len(timings)))
+        elif hasattr(plugin, "finalize"):
+            state = plugin.partial(host_results)
+            results.append(measure(class_name + ".finalize", lambda: plugin.finalize(state), rounds, len(state)))
+    return results
+
+
+def bench_grpc(servicer, payloads, rounds):
+    """Full request path: serialization, servicer and plugin through the local channel"""
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4), options=_GRPC_OPTIONS)
+    aggregator_pb2_grpc.add_AggregatorServicer_to_server(servicer, server)
+    port = server.add_insecure_port("127.0.0.1:0")
+    server.start()
+    results = []
+    try:
+        with grpc.insecure_channel("127.0.0.1:{}".format(port), options=_GRPC_OPTIONS) as channel:
+            stub = aggregator_pb2_grpc.AggregatorStub(channel)
+            for class_name, config in PLUGINS.items():
+                if class_name not in servicer.all_custom_parsers:
+                    continue
+                payload = payloads[class_name]
+                task = aggregator_pb2.AggregatorTask(id="benchmark", config=msgpack.packb(config),
+                                                     frame={"previous": 1, "current": 61}, meta={"host": "host"})
+                host_request = aggregator_pb2.AggregateHostRequest(task=task, class_name=class_name,
+                                                                   payload=payload[0])
+                results.append(measure("grpc.{}.AggregateHost".format(class_name),
+                                       lambda: stub.AggregateHost(host_request), rounds))
+
+                host_results = []
+                for item in payload:
+                    host_request.payload = item
+                    host_results.append(stub.AggregateHost(host_request).result)
+                group_request = aggregator_pb2.AggregateGroupRequest(task=task, class_name=class_name,
+                                                                     payload=host_results)
+                results.append(measure("grpc.{}.AggregateGroup".format(class_name),
+                                       lambda: stub.AggregateGroup(group_request), rounds, len(host_results)))
+    finally:
+        server.stop(0)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Combaine aggregator benchmark")
+    parser.add_argument('--hosts', type=int, default=100, help="Count of hosts in the group")
+    parser.add_argument('--metrics', type=int, default=1000, help="Count of metrics per host")
+    parser.add_argument('--timings-share', type=float, default=0.1, help="Share of timings metrics")
+    parser.add_argument('--timings-per-line', type=int, default=50, help="Count of values per timings line")
+    parser.add_argument('--packed-ratio', type=float, default=0.1, help="Share of packed @timings")
+    parser.add_argument('--rounds', type=int, default=20, help="Measured calls per benchmark")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-grpc', action='store_true', help="Do not benchmark the servicer")
+    parser.add_argument('--output', default=None, help="Write json to the file instead of stdout")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    rnd = random.Random(args.seed)
+    shape = dict(metrics=args.metrics, timings_share=args.timings_share, timings_per_line=args.timings_per_line)
+    hosts = [generate_payload(rnd, packed_ratio=args.packed_ratio, **shape) for _ in range(args.hosts)]
+    payloads = {"Multimetrics": hosts, "Apdex": hosts}
+
+    servicer = aggregator.Aggregator()
+    results = bench_plugins(servicer, payloads, args.rounds)
+    if not args.no_grpc:
+        results.extend(bench_grpc(servicer, payloads, args.rounds))
+
+    report = {
+        "params": vars(args),
+        "python": platform.python_version(),
+        # msgpack.fallback is the pure python implementation
+        "msgpack": "{} {}".format(".".join(map(str, msgpack.version)), msgpack.Packer.__module__),
+        "time": int(time.time()),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Replay of requests captured by the aggregator (--capture) against the in-process servicer
+or the aggregator on the endpoint. Throughput and latency of every method and class are printed as json:
+
+    PLUGINS_PATH=plugins/aggregators python3 aggregator/replay.py --concurrency 4 --profile capture.1234
+    python3 aggregator/replay.py --endpoint localhost:10052 --rate 20 capture.1234.1 capture.1234
+"""
+import argparse
+import collections
+import contextlib
+import cProfile
+import io
+import itertools
+import json
+import logging
+import math
+import platform
+import pstats
+import sys
+import threading
+import time
+from concurrent import futures
+
+import grpc
+import msgpack
+
+import aggregator
+import aggregator_pb2
+import aggregator_pb2_grpc
+
+_GRPC_OPTIONS = (
+    ('grpc.max_send_message_length', 128 * 1024 * 1024),
+    ('grpc.max_receive_message_length', 128 * 1024 * 1024),
+)
+
+REQUESTS = {
+    "AggregateHost": aggregator_pb2.AggregateHostRequest,
+    "AggregateGroup": aggregator_pb2.AggregateGroupRequest,
+    "AggregateGroupStream": aggregator_pb2.AggregateGroupRequest,
+    "AggregatePartial": aggregator_pb2.AggregateGroupRequest,
+    "AggregateFinalize": aggregator_pb2.AggregateGroupRequest,
+    "MergePartials": aggregator_pb2.AggregateGroupRequest,
+    "AggregateHierarchy": aggregator_pb2.AggregateHierarchyRequest,
+}
+
+
+def read_capture(paths, methods=None):
+    """Captured records of all files in order of their start, requests are decoded"""
+    records = []
+    for path in paths:
+        with open(path, 'rb') as capture:
+            # the last record of the file may be truncated, it is skipped
+            for record in msgpack.Unpacker(capture, raw=False, max_buffer_size=512 * 1024 * 1024):
+                method = record["method"]
+                if methods and method not in methods:
+                    continue
+                message = REQUESTS[method]
+                if isinstance(record["request"], list):
+                    record["request"] = [message.FromString(chunk) for chunk in record["request"]]
+                else:
+                    record["request"] = message.FromString(record["request"])
+                records.append(record)
+    records.sort(key=lambda record: record["start"])
+    return records
+
+
+class _Context():
+    """Context of the in-process servicer call, requests are replayed without deadlines"""
+
+    def __init__(self):
+        self.code = None
+        self.details = None
+
+    def set_code(self, code):
+        self.code = code
+
+    def set_details(self, details):
+        self.details = details
+
+    def time_remaining(self):  # pylint: disable=no-self-use
+        return None
+
+    def is_active(self):  # pylint: disable=no-self-use
+        return True
+
+
+class _Profiles():
+    """cProfile of replayed calls, every worker thread has its own profile"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profiles = []
+
+    @contextlib.contextmanager
+    def profile(self):
+        profile = getattr(self.local, "profile", None)
+        if profile is None:
+            profile = self.local.profile = cProfile.Profile()
+            with self.lock:
+                self.profiles.append(profile)
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+
+    def stats(self):
+        return pstats.Stats(*self.profiles) if self.profiles else None
+
+
+def replay(call, records, rate=0, concurrency=1, loops=1, profiles=None):
+    """
+    Send records `loops` times at `rate` per second (0 - as fast as `concurrency` allows),
+    latency of the call is measured from its start. Returns latencies and errors by (method, class)
+    and elapsed seconds
+    """
+    lock = threading.Lock()
+    latencies = collections.defaultdict(list)
+    errors = collections.Counter()
+    slots = threading.Semaphore(concurrency)
+
+    profile = profiles.profile if profiles is not None else contextlib.ExitStack
+
+    def run(record):
+        key = (record["method"], record["class_name"])
+        request = record["request"]
+        try:
+            with profile():
+                start = time.perf_counter()
+                try:
+                    call(record["method"], iter(request) if isinstance(request, list) else request)
+                    failed = False
+                except Exception as err:  # pylint: disable=broad-except
+                    logging.debug("%s %s failed: %s", key[0], key[1], err)
+                    failed = True
+                duration = time.perf_counter() - start
+            with lock:
+                latencies[key].append(duration)
+                if failed:
+                    errors[key] += 1
+        finally:
+            slots.release()
+
+    with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        begin = time.perf_counter()
+        for idx, record in enumerate(itertools.chain.from_iterable(itertools.repeat(records, loops))):
+            if rate:
+                delay = begin + idx / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            slots.acquire()
+            executor.submit(run, record)
+    return latencies, errors, time.perf_counter() - begin
+
+
+def percentile(values, quant):
+    """Percentile of the sorted list"""
+    return values[max(0, int(math.ceil(quant / 100.0 * len(values))) - 1)]
+
+
+def report(records, latencies, errors, elapsed):
+    """
+    Replayed latency and throughput of every method and class, compared with
+    the captured latency measured by the server, which does not include the transport
+    """
+    captured = collections.defaultdict(list)
+    for record in records:
+        captured[(record["method"], record["class_name"])].append(record["duration"])
+
+    results = []
+    for (method, class_name), values in sorted(latencies.items()):
+        values.sort()
+        recorded = sorted(captured[(method, class_name)])
+        results.append({
+            "method": method,
+            "class_name": class_name,
+            "requests": len(values),
+            "errors": errors[(method, class_name)],
+            "mean_ms": sum(values) / len(values) * 1000,
+            "p50_ms": percentile(values, 50) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+            "max_ms": values[-1] * 1000,
+            "requests_per_sec": len(values) / elapsed if elapsed else None,
+            "captured_p50_ms": percentile(recorded, 50) * 1000,
+            "captured_p99_ms": percentile(recorded, 99) * 1000,
+        })
+        logging.info("%s %s: %d requests, p50 %.3f ms (captured %.3f ms), p99 %.3f ms, %.1f rps",
+                     method, class_name, len(values), results[-1]["p50_ms"], results[-1]["captured_p50_ms"],
+                     results[-1]["p99_ms"], results[-1]["requests_per_sec"] or 0)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay of requests captured by the Combaine aggregator")
+    parser.add_argument('capture', nargs='+', help="Capture files, records of all of them are replayed in order")
+    parser.add_argument('--endpoint', default=None,
+                        help="Replay against the aggregator on the endpoint (default - in-process servicer)")
+    parser.add_argument('--rate', type=float, default=0,
+                        help="Requests per second (0 - as fast as concurrency allows)")
+    parser.add_argument('--concurrency', type=int, default=1, help="Max requests running at once")
+    parser.add_argument('--loops', type=int, default=1, help="Replay the capture N times")
+    parser.add_argument('--methods', default=None, help="Comma separated methods to replay (default - all)")
+    parser.add_argument('--profile', action='store_true',
+                        help="Profile the in-process servicer and print the top functions to stderr")
+    parser.add_argument('--profile-output', default=None, help="Dump the profile for pstats to the file")
+    parser.add_argument('--output', default=None, help="Write json to the file instead of stdout")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if (args.profile or args.profile_output) and args.endpoint:
+        parser.error("profile is collected by the in-process servicer, use the Profile method for the endpoint")
+
+    methods = set(args.methods.split(",")) if args.methods else None
+    records = read_capture(args.capture, methods)
+    if not records:
+        parser.error("no requests to replay")
+    logging.info("Replay %d requests of %s", len(records), ", ".join(args.capture))
+
+    channel = None
+    if args.endpoint:
+        channel = grpc.insecure_channel(args.endpoint, options=_GRPC_OPTIONS)
+        stub = aggregator_pb2_grpc.AggregatorStub(channel)
+
+        def call(method, request):
+            getattr(stub, method)(request)
+    else:
+        servicer = aggregator.Aggregator()
+
+        def call(method, request):
+            getattr(servicer, method)(request, _Context())
+
+    profiles = _Profiles() if args.profile or args.profile_output else None
+    try:
+        latencies, errors, elapsed = replay(call, records, args.rate, args.concurrency, args.loops, profiles)
+    finally:
+        if channel is not None:
+            channel.close()
+
+    stats = profiles.stats() if profiles is not None else None
+    if stats is not None:
+        if args.profile_output:
+            stats.dump_stats(args.profile_output)
+        if args.profile:
+            output = io.StringIO()
+            stats.stream = output
+            stats.sort_stats("cumulative").print_stats(50)
+            sys.stderr.write(output.getvalue())
+
+    result = {
+        "params": vars(args),
+        "python": platform.python_version(),
+        "msgpack": "{} {}".format(".".join(map(str, msgpack.version)), msgpack.Packer.__module__),
+        "time": int(time.time()),
+        "elapsed": elapsed,
+        "results": report(records, latencies, errors, elapsed),
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(result, output, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,10 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# generated by `make proto` in to the aggregator directory with the servicer
+sys.path.insert(0, os.path.join(ROOT, "aggregator"))
+os.environ.setdefault("PLUGINS_PATH", os.path.join(ROOT, "plugins", "aggregators"))
+# plugins and their shared modules are tested directly too
+sys.path.append(os.environ["PLUGINS_PATH"])
@@ -0,0 +1,120 @@
+"""Admission control of plugin calls"""
+import threading
+
+import grpc
+import pytest
+
+import aggregator
+
+
+class Context():
+    def __init__(self, remaining=None):
+        self.remaining = remaining
+        self.code = None
+
+    def set_code(self, code):
+        self.code = code
+
+    def set_details(self, details):
+        pass
+
+    def time_remaining(self):
+        return self.remaining
+
+    def is_active(self):
+        return True
+
+
+def run(admission, size, remaining=None, method="AggregateHost"):
+    context = Context(remaining)
+    try:
+        with admission.admit(method, "Multimetrics", context, size):
+            pass
+    except RuntimeError:
+        pass
+    return context.code
+
+
+def learn(admission, per_byte, age=0.0, method="AggregateHost"):
+    """Expected duration as if requests took `per_byte` seconds per byte `age` seconds ago"""
+    admission.durations[(method, "Multimetrics")] = [per_byte, aggregator.time.monotonic() - age]
+
+
+def test_admitted_without_samples():
+    admission = aggregator._Admission(1, 1)
+    assert run(admission, 1000, remaining=0.001) is None
+    assert admission.free == 1
+
+
+def test_deadline_is_compared_with_duration_of_the_size():
+    admission = aggregator._Admission(1, 1)
+    # 1.7 s request of 10 Kb
+    learn(admission, 1.7 / 10000)
+    assert run(admission, 10000, remaining=0.05) == grpc.StatusCode.DEADLINE_EXCEEDED
+    assert all(run(admission, 100, remaining=0.05) is None for _ in range(20))
+    # other methods and classes are not affected
+    assert run(admission, 10000, remaining=0.05, method="AggregateGroup") is None
+
+
+def test_expected_duration_decays():
+    admission = aggregator._Admission(1, 1)
+    learn(admission, 1.0 / 1000, age=aggregator._DURATION_HALF_LIFE)
+    assert run(admission, 1000, remaining=0.4) == grpc.StatusCode.DEADLINE_EXCEEDED
+    assert run(admission, 1000, remaining=0.6) is None
+
+
+def test_expected_duration_ages_out():
+    admission = aggregator._Admission(1, 1)
+    learn(admission, 1.0, age=aggregator._DURATION_TTL + 1)
+    assert run(admission, 1000, remaining=0.05) is None
+    # the stale estimate is replaced by the admitted request
+    assert admission.durations[("AggregateHost", "Multimetrics")][0] < 0.001
+
+
+def test_queue_is_full():
+    admission = aggregator._Admission(1, 1)
+    running = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with admission.admit("AggregateHost", "Multimetrics", Context(), 1):
+            running.set()
+            release.wait(10)
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    try:
+        assert running.wait(10)
+        queued = threading.Thread(target=run, args=(admission, 1))
+        queued.start()
+        while not admission.waiting:
+            aggregator.time.sleep(0.01)
+        assert run(admission, 1) == grpc.StatusCode.RESOURCE_EXHAUSTED
+    finally:
+        release.set()
+        holder.join(10)
+    queued.join(10)
+    assert admission.free == 1 and not admission.waiting
+
+
+@pytest.mark.parametrize("remaining,code", [(0.01, grpc.StatusCode.DEADLINE_EXCEEDED), (None, None)])
+def test_queued_until_deadline(remaining, code):
+    admission = aggregator._Admission(1, 1)
+    release = threading.Event()
+    running = threading.Event()
+
+    def hold():
+        with admission.admit("AggregateHost", "Multimetrics", Context(), 1):
+            running.set()
+            release.wait(10)
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    assert running.wait(10)
+    if remaining is None:
+        threading.Timer(0.1, release.set).start()
+    try:
+        assert run(admission, 1, remaining=remaining, method="AggregateGroup") == code
+    finally:
+        release.set()
+        holder.join(10)
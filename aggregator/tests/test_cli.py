@@ -0,0 +1,100 @@
+"""Smoke tests of the aggregator.py command line entry point"""
+import json
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import grpc
+import msgpack
+import pytest
+
+import aggregator_pb2
+import aggregator_pb2_grpc
+
+from conftest import ROOT
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    # zombie of the exited process is alive for kill
+    with open("/proc/{}/stat".format(pid)) as stat:
+        return stat.read().split()[2] != "Z"
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_pool_mode(tmp_path, workers):
+    port = _free_port()
+    cmd = [sys.executable, os.path.join(ROOT, "aggregator", "aggregator.py"),
+           "--endpoint", "127.0.0.1:{}".format(port), "--logoutput", str(tmp_path / "aggregator.log"),
+           "--workers", str(workers), "--pool-processes", "2"]
+    server = subprocess.Popen(cmd)
+    try:
+        with grpc.insecure_channel("127.0.0.1:{}".format(port)) as channel:
+            grpc.channel_ready_future(channel).result(timeout=30)
+            stub = aggregator_pb2_grpc.AggregatorStub(channel)
+            config = msgpack.packb({"windows": {"_3m": 180}})
+            task = aggregator_pb2.AggregatorTask(id="smoke", name="cfg", config=config,
+                                                 frame={"previous": 0, "current": 60},
+                                                 meta={"metahost": "m", "aggregate": "a"})
+            for _ in range(2 * workers):
+                host = stub.AggregateHost(aggregator_pb2.AggregateHostRequest(
+                    task=task, class_name="Multimetrics", payload=b"api.2xx 60\napi_timings 1 2 3"), timeout=10)
+                group = stub.AggregateGroup(aggregator_pb2.AggregateGroupRequest(
+                    task=task, class_name="Multimetrics", payload=[host.result] * 2), timeout=10)
+                result = msgpack.unpackb(group.result, raw=False)
+                assert result["api.2xx"] == 2.0
+                # pool processes see a part of frames, windows are disabled
+                assert "api.2xx_3m" not in result
+            stats = json.loads(stub.Stats(aggregator_pb2.StatsRequest(), timeout=10).stats)
+            assert "multi_metrics" in stats["load_timings"]
+    finally:
+        server.send_signal(signal.SIGTERM)
+        assert server.wait(timeout=30) in (0, -signal.SIGTERM)
+
+    log = open(str(tmp_path / "aggregator.{}.log".format(port))).read()
+    assert "worker exit by" not in log
+    assert "Sliding windows are disabled" in log
+    # supervised workers and pool processes go away with the supervisor
+    pids = [int(pid) for pid in re.findall(r"worker started pid=(\d+)", log)]
+    assert len(pids) == (workers if workers > 1 else 0)
+    deadline = time.time() + 10
+    while any(map(_alive, pids)) and time.time() < deadline:
+        time.sleep(0.1)
+    assert not any(map(_alive, pids))
+
+
+def test_recycle_workers(tmp_path):
+    port = _free_port()
+    cmd = [sys.executable, os.path.join(ROOT, "aggregator", "aggregator.py"),
+           "--endpoint", "127.0.0.1:{}".format(port), "--logoutput", str(tmp_path / "aggregator.log"),
+           "--workers", "2", "--max-requests", "1"]
+    server = subprocess.Popen(cmd)
+    try:
+        with grpc.insecure_channel("127.0.0.1:{}".format(port)) as channel:
+            grpc.channel_ready_future(channel).result(timeout=30)
+            stub = aggregator_pb2_grpc.AggregatorStub(channel)
+            stub.Ping(aggregator_pb2.PingRequest(), timeout=10)
+            # recycled worker is checked every 5 seconds, the replacement serves new requests
+            time.sleep(8)
+            stub.Ping(aggregator_pb2.PingRequest(), timeout=10, wait_for_ready=True)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=30)
+
+    log = open(str(tmp_path / "aggregator.{}.log".format(port))).read()
+    assert "Recycle server after" in log
+    assert len(re.findall(r"worker started pid=(\d+)", log)) >= 3
+    assert "worker exit by" not in log
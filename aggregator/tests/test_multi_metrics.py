@@ -0,0 +1,139 @@
+"""Timings of the Multimetrics plugin: histogram, coarsening, merge and typed form"""
+import random
+
+import msgpack
+import pytest
+
+import multi_metrics
+
+QUANTILES = [0, 1, 25, 50, 75, 90, 99, 99.9, 100]
+
+
+@pytest.fixture(name="engine", params=["numpy", "python"])
+def fixture_engine(request, monkeypatch):
+    if request.param == "python":
+        monkeypatch.setattr(multi_metrics, "np", None)
+    elif multi_metrics.np is None:
+        pytest.skip("numpy is not available")
+    return request.param
+
+
+def random_timings(rnd, size, scale=1.0):
+    timings = {}
+    for _ in range(size):
+        value = round(rnd.lognormvariate(0, 2) * scale, 6)
+        timings[value] = timings.get(value, 0.0) + rnd.randint(1, 5)
+    return timings
+
+
+def host_payload(rnd, lines):
+    return "\n".join("api_timings " + " ".join("%.4f" % rnd.lognormvariate(-3, 1.5) for _ in range(200))
+                     for _ in range(lines)).encode()
+
+
+@pytest.mark.parametrize("sub_buckets", [8, 64])
+def test_histogram_quantiles_error(engine, sub_buckets):
+    rnd = random.Random(sub_buckets)
+    config = {"min": 1e-3, "max": 1e3, "sub_buckets": sub_buckets}
+    hist = multi_metrics._Histogram(config)
+    timings = random_timings(rnd, 5000)
+    exact = multi_metrics.Multimetrics({"values": QUANTILES}).calculate_quantiles(timings, sum(timings.values()))
+    compact = hist.merge([hist.from_timings(timings)])
+    approx = hist.quantiles(compact, QUANTILES)
+
+    # the quantile is the middle of the bucket of the exact one
+    assert approx == [hist.value(hist.index(value)) for value in exact]
+    for value, estimate in zip(exact, approx):
+        if config["min"] <= value < config["max"]:
+            assert abs(estimate - value) <= value / (2 * sub_buckets)
+        else:
+            assert estimate == (config["min"] if value < config["min"] else config["max"])
+    # quantiles 0 and 100 are the buckets of the least and the greatest values
+    assert approx[0] == hist.value(hist.index(min(timings)))
+    assert approx[-1] == hist.value(hist.index(max(timings)))
+
+
+def test_histogram_group_result(engine):
+    rnd = random.Random(5)
+    config = {"values": QUANTILES, "histogram": {"sub_buckets": 32}}
+    plugin = multi_metrics.Multimetrics(config)
+    exact_plugin = multi_metrics.Multimetrics({"values": QUANTILES})
+    payloads = [host_payload(rnd, 3) for _ in range(4)]
+    hosts = [msgpack.unpackb(msgpack.packb(plugin.aggregate_host(p, 0, 60)), raw=False) for p in payloads]
+
+    approx = plugin.aggregate_group(hosts)["api_timings"]
+    exact = exact_plugin.aggregate_group([exact_plugin.aggregate_host(p, 0, 60) for p in payloads])["api_timings"]
+    assert approx == [plugin.histogram.value(plugin.histogram.index(value)) for value in exact]
+    # merge of partial states is the same as of all hosts at once
+    assert plugin.finalize(plugin.merge([plugin.partial(hosts[:2]), plugin.partial(hosts[2:])]))["api_timings"] == \
+        approx
+
+
+def test_coarsen_timings():
+    rnd = random.Random(7)
+    timings = random_timings(rnd, 3000)
+    for limit in (1000, 100, 10):
+        coarse, merged = multi_metrics._coarsen_timings(timings, limit)
+        assert merged == len(timings) - len(coarse)
+        assert sum(coarse.values()) == sum(timings.values())
+        assert len(coarse) <= limit or len(coarse) == len({float('%.1g' % k) for k in timings})
+        for key in timings:
+            assert any(abs(key - c) <= abs(key) * 0.5 for c in coarse)
+    assert multi_metrics._coarsen_timings({0.1: 1.0, 0.2: 2.0}, 10) == ({0.1: 1.0, 0.2: 2.0}, 0)
+
+
+@pytest.mark.parametrize("size", [multi_metrics.NUMPY_MERGE_THRESHOLD - 1, multi_metrics.NUMPY_MERGE_THRESHOLD,
+                                  5 * multi_metrics.NUMPY_MERGE_THRESHOLD])
+def test_merge_timings_across_numpy_threshold(monkeypatch, size):
+    rnd = random.Random(size)
+    timings = []
+    left = size
+    while left:
+        # distinct values of every dict, values are shared between dicts
+        keys = rnd.sample(range(2 * size), min(left, rnd.randint(1, 100)))
+        timings.append({key / 1000.0: float(rnd.randint(1, 9)) for key in keys})
+        left -= len(keys)
+    typed = [multi_metrics._pack_timings(t) if idx % 2 else t for idx, t in enumerate(timings)]
+
+    merged = multi_metrics._merge_timings(timings)
+    merged_typed = multi_metrics._unpack_timings(multi_metrics._merge_timings(typed, typed=True))
+    with monkeypatch.context() as patch:
+        patch.setattr(multi_metrics, "np", None)
+        expected = multi_metrics._merge_timings(timings)
+        assert multi_metrics._unpack_timings(multi_metrics._merge_timings(typed, typed=True)) == expected
+    assert merged == expected
+    assert merged_typed == expected
+    assert sum(expected.values()) == sum(sum(t.values()) for t in timings)
+
+
+def test_typed_timings_round_trip(engine):
+    timings = {0.001: 3.0, 0.25: 1.0, 12.5: 7.0, float("inf"): 1.0}
+    ext = msgpack.unpackb(msgpack.packb(multi_metrics._pack_timings(timings)), raw=False)
+    assert isinstance(ext, msgpack.ExtType) and ext.code == multi_metrics.TIMINGS_EXT
+    assert multi_metrics._unpack_timings(ext) == timings
+
+    rnd = random.Random(11)
+    payloads = [host_payload(rnd, 2) for _ in range(3)]
+    typed_plugin = multi_metrics.Multimetrics({"typed_timings": True})
+    plugin = multi_metrics.Multimetrics({})
+    typed = [msgpack.unpackb(msgpack.packb(typed_plugin.aggregate_host(p, 0, 60)), raw=False) for p in payloads]
+    assert all(isinstance(host["api_timings"], msgpack.ExtType) for host in typed)
+    assert typed_plugin.aggregate_group(typed) == plugin.aggregate_group([plugin.aggregate_host(p, 0, 60)
+                                                                          for p in payloads])
+
+
+def test_timings_are_parsed_as_bytes(engine):
+    payload = b"\n".join([
+        b"api_timings 0.1,0.2:0.1 0.3",
+        b"@packed_timings 0.1@2 0.2@3 @5 0.4",
+        b"@pairs_timings 0.1@2 0.2@3.5 0.1@1",
+        b"broken_timings 0.1 x 0.2",
+    ])
+    plugin = multi_metrics.Multimetrics({"values": [50], "engine": engine})
+    result = plugin.aggregate_host(payload, 0, 60)
+    assert result["api_timings"] == {0.1: 2.0, 0.2: 1.0, 0.3: 1.0}
+    # entries without count or value are skipped
+    assert result["@packed_timings"] == {0.1: 2.0, 0.2: 3.0}
+    assert result["@pairs_timings"] == {0.1: 3.0, 0.2: 3.5}
+    # values before the broken one are kept
+    assert result["broken_timings"] == {0.1: 1.0}
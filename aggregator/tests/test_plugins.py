@@ -0,0 +1,241 @@
+"""Loading of aggregator plugins and their shared modules"""
+import os
+import random
+import time
+
+import msgpack
+import pytest
+
+import _derived
+import aggregator
+import aggregator_pb2
+
+SAMPLE_PLUGIN = '''
+import collections
+from collections import OrderedDict as Ordered
+
+LIMIT = 10
+NUMPY_THRESHOLD = 512
+DEFAULT_QUANTILE_VALUES = [75, 90, 99]
+
+
+class Base():
+    def __init__(self, config):
+        self.config = config
+
+
+def Factory(config):
+    return Base(config)
+
+
+Alias = Base
+Timings = collections.Counter
+First, Second = Base, Factory
+'''
+
+SHARED_MODULE = '''
+class Shared():
+    def __init__(self, config):
+        self.config = config
+'''
+
+STAR_PLUGIN = '''
+from _shared_lazy_test import *
+'''
+
+
+class Context():
+    def __init__(self):
+        self.code = None
+
+    def set_code(self, code):
+        self.code = code
+
+    def set_details(self, details):
+        pass
+
+    def time_remaining(self):
+        return None
+
+    def is_active(self):
+        return True
+
+
+@pytest.fixture(name="plugins")
+def fixture_plugins(tmp_path, monkeypatch):
+    (tmp_path / "sample.py").write_text(SAMPLE_PLUGIN)
+    (tmp_path / "_shared_lazy_test.py").write_text(SHARED_MODULE)
+    (tmp_path / "star.py").write_text(STAR_PLUGIN)
+    monkeypatch.setenv("PLUGINS_PATH", str(tmp_path))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    return tmp_path
+
+
+def test_lazy_plugins_serve_classes_of_eager(plugins):
+    eager = aggregator.Aggregator()
+    classes = {"Base", "Factory", "Alias", "Timings", "First", "Second", "Ordered", "Shared"}
+    assert set(eager.all_custom_parsers) == classes
+
+    lazy = aggregator.Aggregator(lazy=True)
+    # module with `import *` is imported, the rest are scanned
+    assert not isinstance(lazy.all_custom_parsers["Shared"], aggregator._LazyPlugin)
+    assert isinstance(lazy.all_custom_parsers["Alias"], aggregator._LazyPlugin)
+    assert set(lazy.all_custom_parsers) == classes | {"LIMIT", "NUMPY_THRESHOLD", "DEFAULT_QUANTILE_VALUES"}
+    for name in sorted(classes):
+        # modules are imported by each servicer, classes are equal by names
+        assert lazy.getClass(lazy.log, name, Context()).__name__ == eager.getClass(eager.log, name, Context()).__name__
+
+    # constants are dropped by the import
+    assert set(lazy.all_custom_parsers) == classes
+    context = Context()
+    with pytest.raises(NameError):
+        lazy.getClass(lazy.log, "LIMIT", context)
+    assert context.code is not None
+
+
+def calculate_percentage(get_prc, result):
+    """get_prc of Multimetrics before the derived metrics stage"""
+    for pattern in get_prc:
+        calc_result = {}
+        base_key, all_key = get_prc[pattern].split('/')
+        for metric in result:
+            if pattern not in metric:
+                continue
+            metric_prefix = metric.rsplit('.', 1)[0]
+            metric_base = '%s.%s' % (metric_prefix, base_key)
+            metric_all = '%s.%s' % (metric_prefix, all_key)
+            metric_result = '%s.err_prc' % (metric_prefix)
+            if metric_result in calc_result:
+                continue
+            try:
+                metric_base_value = result[metric_base]
+            except KeyError:
+                calc_result[metric_result] = 0
+                continue
+            try:
+                metric_all_value = result[metric_all]
+            except KeyError:
+                calc_result[metric_result] = 100
+                continue
+            if metric_all_value < metric_base_value:
+                calc_result[metric_result] = 100
+            else:
+                calc_result[metric_result] = round(metric_base_value * 100.0 / metric_all_value, 2)
+        result.update(calc_result)
+    return result
+
+
+RESULT = {
+    "ext_services.api.error": 3, "ext_services.api.info": 30,
+    "ext_services.db.error": 5,
+    "ext_services.cache.info": 10,
+    "ext_services_old.api.error": 10, "ext_services_old.api.info": 5,
+    "services.api.error": 1, "services.api.info": 2,
+    "api.2xx": 90, "api.5xx": 10, "api": 7,
+}
+
+
+@pytest.mark.parametrize("get_prc", [
+    # exact prefix
+    {"ext_services.api": "error/info"},
+    # prefix of many prefixes
+    {"ext_services": "error/info"},
+    # overlapping prefixes, the later one overrides the earlier results
+    {"services": "error/info", "ext_services": "info/error"},
+    # pattern spans the prefix and the last part
+    {"api.er": "error/info", "api.2": "5xx/2xx"},
+    # the last part only and the metric without dots
+    {"rror": "error/info", "api": "5xx/2xx"},
+    # no match
+    {"missing": "error/info", "ext_services.api.error.": "error/info"},
+])
+def test_derived_percentage_matches_get_prc(get_prc):
+    expected = calculate_percentage(get_prc, dict(RESULT))
+    derived = _derived.Derived(get_prc).apply(dict(RESULT))
+    assert list(derived.items()) == list(expected.items())
+
+
+def test_derived_percentage_matches_get_prc_on_random_results():
+    rnd = random.Random(22)
+    parts = ["a", "ab", "b", "api", "ext", "error", "info", "2xx", "5xx", "err"]
+    for _ in range(300):
+        result = {}
+        for _ in range(rnd.randint(0, 30)):
+            name = ".".join(rnd.choice(parts) for _ in range(rnd.randint(1, 4)))
+            result[name] = rnd.randint(0, 100)
+        get_prc = {}
+        for _ in range(rnd.randint(1, 3)):
+            pattern = ".".join(rnd.choice(parts) for _ in range(rnd.randint(1, 2)))
+            get_prc[pattern[rnd.randint(0, 2):]] = rnd.choice(["error/info", "5xx/2xx", "err/ab"])
+        expected = calculate_percentage(get_prc, dict(result))
+        assert list(_derived.Derived(get_prc).apply(dict(result)).items()) == list(expected.items()), get_prc
+
+
+def test_derived_metrics():
+    derived = _derived.Derived(derived={"api": {"total": "2xx+5xx+3xx", "ok": "2xx/total"}})
+    result = derived.apply({"api.2xx": 90, "api.5xx": 10, "ext.api.5xx": 1, "other.2xx": 5})
+    assert result["api.total"] == 100
+    assert result["api.ok"] == 0.9
+    # missing numerator is not derived
+    assert result["ext.api.total"] == 1 and "ext.api.ok" not in result
+    assert "other.total" not in result
+
+
+VERSIONED_PLUGIN = '''
+class Versioned():
+    reusable = True
+
+    def __init__(self, config):
+        self.config = config
+
+    def aggregate_host(self, payload, prevtime, currtime, hostname=None):
+        return {"version": %d}
+'''
+
+
+def write_plugin(path, source, stamp):
+    path.write_text(source)
+    # mtime of the edit is after the import of the previous version
+    os.utime(str(path), (stamp, stamp))
+
+
+def host_version(servicer, task):
+    request = aggregator_pb2.AggregateHostRequest(task=task, class_name="Versioned", payload=b"")
+    return msgpack.unpackb(servicer.AggregateHost(request, Context()).result, raw=False)["version"]
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_reload_changed_plugin(tmp_path, monkeypatch, lazy):
+    plugin = tmp_path / "versioned.py"
+    write_plugin(plugin, VERSIONED_PLUGIN % 1, time.time() - 100)
+    monkeypatch.setenv("PLUGINS_PATH", str(tmp_path))
+    servicer = aggregator.Aggregator(lazy=lazy)
+    task = aggregator_pb2.AggregatorTask(id="test", config=msgpack.packb({}))
+    assert host_version(servicer, task) == 1
+
+    write_plugin(plugin, VERSIONED_PLUGIN % 2 + "\n\nclass Added(Versioned):\n    pass\n", time.time() - 50)
+    servicer.reload_plugins()
+    # the cached reusable instance is replaced by the one of the new class
+    assert host_version(servicer, task) == 2
+    assert servicer.getClass(servicer.log, "Added", Context()).__name__ == "Added"
+
+    # the broken version keeps the previous classes
+    write_plugin(plugin, "class Versioned(:\n", time.time() - 10)
+    servicer.reload_plugins()
+    assert host_version(servicer, task) == 2
+
+
+def test_watcher_reloads_plugins(tmp_path, monkeypatch):
+    plugin = tmp_path / "versioned.py"
+    write_plugin(plugin, VERSIONED_PLUGIN % 1, time.time() - 100)
+    monkeypatch.setenv("PLUGINS_PATH", str(tmp_path))
+    servicer = aggregator.Aggregator()
+    servicer.start_watcher(0.05)
+    task = aggregator_pb2.AggregatorTask(id="test", config=msgpack.packb({}))
+    assert host_version(servicer, task) == 1
+
+    write_plugin(plugin, VERSIONED_PLUGIN % 2, time.time() - 50)
+    deadline = time.time() + 10
+    while host_version(servicer, task) != 2 and time.time() < deadline:
+        time.sleep(0.05)
+    assert host_version(servicer, task) == 2
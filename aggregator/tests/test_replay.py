@@ -0,0 +1,95 @@
+"""Requests captured by the aggregator and replayed by aggregator/replay.py"""
+import msgpack
+import pytest
+
+import aggregator
+import aggregator_pb2
+import replay
+
+
+@pytest.fixture(name="servicer")
+def fixture_servicer():
+    return aggregator.Aggregator()
+
+
+@pytest.fixture(name="task")
+def fixture_task():
+    return aggregator_pb2.AggregatorTask(id="test", name="cfg", config=msgpack.packb({}),
+                                         frame={"previous": 0, "current": 60},
+                                         meta={"metahost": "m", "aggregate": "a"})
+
+
+def captured_call(servicer, capture, method, request, streaming=False):
+    """Call of the servicer tracked as the request interceptor does"""
+    request, record = capture.track(method, request, streaming)
+    context = replay._Context()
+    response = error = None
+    start = aggregator.time.perf_counter()
+    try:
+        response = getattr(servicer, method)(request, context)
+    except Exception as err:  # pylint: disable=broad-except
+        error = str(err)
+    if record is not None:
+        capture.write(record, aggregator.time.perf_counter() - start, error)
+    return response
+
+
+def requests(task):
+    host = aggregator_pb2.AggregateHostRequest(task=task, class_name="Multimetrics",
+                                               payload=b"api.2xx 60\napi_timings 0.1 0.2 0.3")
+    missing = aggregator_pb2.AggregateHostRequest(task=task, class_name="Missing", payload=b"")
+    return [("AggregateHost", host), ("AggregateHost", missing)]
+
+
+@pytest.mark.parametrize("max_bytes", [0, 200])
+def test_capture_replay_round_trip(servicer, task, tmp_path, max_bytes):
+    path = str(tmp_path / "capture")
+    capture = aggregator._Capture(path, 1.0, max_bytes, backups=10)
+    responses = {}
+    for method, request in requests(task):
+        responses[method, request.class_name] = captured_call(servicer, capture, method, request)
+    result = responses["AggregateHost", "Multimetrics"].result
+    group = aggregator_pb2.AggregateGroupRequest(task=task, class_name="Multimetrics", payload=[result, result])
+    responses["AggregateGroup", "Multimetrics"] = captured_call(servicer, capture, "AggregateGroup", group)
+    responses["AggregateGroupStream", "Multimetrics"] = captured_call(
+        servicer, capture, "AggregateGroupStream", iter([group, group]), streaming=True)
+    # Ping is not captured
+    captured_call(servicer, capture, "Ping", aggregator_pb2.PingRequest())
+
+    files = sorted(tmp_path.iterdir(), reverse=True)
+    assert (len(files) > 1) == bool(max_bytes)
+    records = replay.read_capture([str(f) for f in files])
+    assert [(r["method"], r["class_name"]) for r in records] == [
+        ("AggregateHost", "Multimetrics"), ("AggregateHost", "Missing"), ("AggregateGroup", "Multimetrics"),
+        ("AggregateGroupStream", "Multimetrics")]
+    assert [r["error"] is not None for r in records] == [False, True, False, False]
+    assert all(r["duration"] > 0 for r in records)
+    assert len(records[-1]["request"]) == 2
+    assert [r["method"] for r in replay.read_capture([str(f) for f in files], {"AggregateGroup"})] == \
+        ["AggregateGroup"]
+
+    # captured requests get the same responses from the fresh servicer
+    replayed = aggregator.Aggregator()
+    results = {}
+
+    def call(method, request):
+        if method == "AggregateGroupStream":
+            chunks = list(request)
+            class_name, request = chunks[0].class_name, iter(chunks)
+        else:
+            class_name = request.class_name
+        results[method, class_name] = getattr(replayed, method)(request, replay._Context())
+
+    latencies, errors, elapsed = replay.replay(call, records, concurrency=2, loops=3)
+    assert elapsed > 0
+    assert {key: len(values) for key, values in latencies.items()} == {
+        ("AggregateHost", "Multimetrics"): 3, ("AggregateGroup", "Multimetrics"): 3,
+        ("AggregateHost", "Missing"): 3, ("AggregateGroupStream", "Multimetrics"): 3}
+    assert errors == {("AggregateHost", "Missing"): 3}
+    assert results.keys() == responses.keys() - {("AggregateHost", "Missing")}
+    for key, response in results.items():
+        assert response == responses[key], key
+
+    report = replay.report(records, latencies, errors, elapsed)
+    assert [(r["method"], r["requests"], r["errors"]) for r in report] == [
+        ("AggregateGroup", 3, 0), ("AggregateGroupStream", 3, 0), ("AggregateHost", 3, 3), ("AggregateHost", 3, 0)]
@@ -0,0 +1,261 @@
+"""Aggregator servicer called in process"""
+import json
+import os
+import signal
+import threading
+import time
+
+import grpc
+import msgpack
+import pytest
+
+import aggregator
+import aggregator_pb2
+from conftest import ROOT
+
+
+class Context():
+    def __init__(self):
+        self.code = None
+        self.details = None
+
+    def set_code(self, code):
+        self.code = code
+
+    def set_details(self, details):
+        self.details = details
+
+    def time_remaining(self):
+        return None
+
+    def is_active(self):
+        return True
+
+
+def host_result(servicer, task, payload):
+    request = aggregator_pb2.AggregateHostRequest(task=task, class_name="Multimetrics", payload=payload)
+    return servicer.AggregateHost(request, Context()).result
+
+
+@pytest.fixture(name="servicer")
+def fixture_servicer():
+    return aggregator.Aggregator()
+
+
+@pytest.fixture(name="task")
+def fixture_task():
+    return aggregator_pb2.AggregatorTask(id="test", name="cfg", config=msgpack.packb({}),
+                                         frame={"previous": 0, "current": 60},
+                                         meta={"metahost": "m", "aggregate": "a"})
+
+
+def test_stalled_stream_does_not_hold_admission(servicer, task):
+    servicer.set_admission(1, 0)
+    result = host_result(servicer, task, b"api.2xx 60")
+    chunk = aggregator_pb2.AggregateGroupRequest(task=task, class_name="Multimetrics", payload=[result])
+    stalled = threading.Event()
+    resume = threading.Event()
+
+    def chunks():
+        yield chunk
+        stalled.set()
+        resume.wait(10)
+        yield chunk
+
+    response = {}
+    stream = threading.Thread(target=lambda: response.update(
+        result=servicer.AggregateGroupStream(chunks(), Context()).result))
+    stream.start()
+    try:
+        assert stalled.wait(10)
+        context = Context()
+        group = aggregator_pb2.AggregateGroupRequest(task=task, class_name="Multimetrics", payload=[result])
+        assert msgpack.unpackb(servicer.AggregateGroup(group, context).result, raw=False) == {"api.2xx": 1.0}
+        assert context.code is None
+    finally:
+        resume.set()
+        stream.join(10)
+    assert msgpack.unpackb(response["result"], raw=False) == {"api.2xx": 2.0}
+    assert servicer.admission.free == 1
+
+
+def test_apdex_skips_metrics_without_values(servicer, task):
+    with open(os.path.join(ROOT, "testdata", "payload", "multimetrics.txt"), "rb") as payload:
+        payload = payload.read()
+    task.config = msgpack.packb({"satisfied": 0.3, "tolerating": 0.9})
+    request = aggregator_pb2.AggregateHostRequest(task=task, class_name="Apdex", payload=payload)
+    result = servicer.AggregateHost(request, Context()).result
+    assert ["<>v5_timings", [0, 0, 0]] in msgpack.unpackb(result, raw=False)
+
+    context = Context()
+    group = aggregator_pb2.AggregateGroupRequest(task=task, class_name="Apdex", payload=[result, result])
+    final = msgpack.unpackb(servicer.AggregateGroup(group, context).result, raw=False)
+    assert context.code is None
+    assert "<>v5_timings" not in final
+    assert "v5_timings" in final
+
+
+def group_window(servicer, task, payload, current, name="api.2xx_3m"):
+    task.frame.previous, task.frame.current = current - 60, current
+    result = host_result(servicer, task, payload)
+    request = aggregator_pb2.AggregateGroupRequest(task=task, class_name="Multimetrics", payload=[result])
+    return msgpack.unpackb(servicer.AggregateGroup(request, Context()).result, raw=False).get(name)
+
+
+@pytest.mark.parametrize("rps,expected", [("yes", [None, None, 10.0, 10.0]), ("no", [None, None, 1800, 1800])])
+def test_window_of_constant_rate(servicer, task, rps, expected):
+    task.config = msgpack.packb({"rps": rps, "windows": {"_3m": 180}})
+    assert [group_window(servicer, task, b"api.2xx 600", current) for current in (60, 120, 180, 240)] == expected
+
+
+def test_window_is_not_added_without_all_frames(servicer, task):
+    task.config = msgpack.packb({"rps": "no", "windows": {"_2m": 120}})
+    windows = [group_window(servicer, task, b"api.2xx 1", current, "api.2xx_2m") for current in (60, 120, 240, 300)]
+    # the frame ending at 180 is missed
+    assert windows == [None, 2, None, 2]
+
+
+def test_windows_of_levels_are_apart(servicer, task):
+    task.config = msgpack.packb({"rps": "no", "windows": {"_2m": 120}})
+    windows = []
+    for current in (60, 120, 180):
+        task.meta["type"], task.meta["name"] = "datacenter", "dc1"
+        datacenter = group_window(servicer, task, b"api.2xx 1", current, "api.2xx_2m")
+        task.meta["type"], task.meta["name"] = "metahost", "m"
+        metahost = group_window(servicer, task, b"api.2xx 100", current, "api.2xx_2m")
+
+        task.meta.pop("type")
+        task.meta.pop("name")
+        group = aggregator_pb2.AggregateSubGroup(name="dc1", hosts=["h"],
+                                                 payload=[host_result(servicer, task, b"api.2xx 10")])
+        request = aggregator_pb2.AggregateHierarchyRequest(task=task, class_name="Multimetrics", groups=[group])
+        hierarchy = servicer.AggregateHierarchy(request, Context()).results[-1]
+        windows.append((datacenter, metahost, msgpack.unpackb(hierarchy.result, raw=False).get("api.2xx_2m")))
+    assert windows == [(None, None, None), (2, 200, 20), (2, 200, 20)]
+
+
+def test_stream_is_metahost_of_hierarchy(servicer, task):
+    """The worker streams hosts of the metahost when other levels are not needed"""
+    task.config = msgpack.packb({"rps": "no", "windows": {"_2m": 120}})
+    results = []
+    for current in (60, 120):
+        task.frame.previous, task.frame.current = current - 60, current
+        payloads = [host_result(servicer, task, b"api.2xx %d\napi_timings 1 2 3" % i) for i in range(1, 5)]
+        groups = [aggregator_pb2.AggregateSubGroup(name=dc, hosts=["h1", "h2"], payload=payloads[i:i + 2])
+                  for i, dc in ((0, "dc1"), (2, "dc2"))]
+        request = aggregator_pb2.AggregateHierarchyRequest(task=task, class_name="Multimetrics", groups=groups,
+                                                           skip_per_datacenter=True)
+        hierarchy = servicer.AggregateHierarchy(request, Context()).results
+        assert [r.meta["type"] for r in hierarchy] == ["metahost"]
+
+        streamed = aggregator_pb2.AggregatorTask()
+        streamed.CopyFrom(task)
+        streamed.meta["type"], streamed.meta["name"] = "metahost", "m"
+        chunks = [aggregator_pb2.AggregateGroupRequest(task=streamed, class_name="Multimetrics", payload=payloads[:3]),
+                  aggregator_pb2.AggregateGroupRequest(payload=payloads[3:])]
+        stream = servicer.AggregateGroupStream(iter(chunks), Context())
+        results.append((msgpack.unpackb(hierarchy[0].result, raw=False), msgpack.unpackb(stream.result, raw=False)))
+    assert results[-1][0]["api.2xx_2m"] == 20
+    assert all(left == right for left, right in results)
+
+
+def test_lazy_payload_decoding_is_unpack_phase(servicer, task, monkeypatch):
+    result = host_result(servicer, task, b"api.2xx 60")
+    unpackb = msgpack.unpackb
+
+    def slow_unpackb(packed, **kwargs):
+        time.sleep(0.01)
+        return unpackb(packed, **kwargs)
+
+    monkeypatch.setattr(msgpack, "unpackb", slow_unpackb)
+    request = aggregator_pb2.AggregateGroupRequest(task=task, class_name="Multimetrics", payload=[result] * 10)
+    assert msgpack.unpackb(servicer.AggregateGroup(request, Context()).result, raw=False) == {"api.2xx": 10.0}
+
+    latency = servicer.stats.snapshot()["latency"]["AggregateGroup"]["Multimetrics"]
+    assert all(view["count"] == 1 for view in latency.values())
+    assert latency["unpack"]["sum"] >= 0.1
+    assert latency["plugin"]["sum"] < latency["unpack"]["sum"]
+
+
+MUTATING_PLUGIN = '''
+class Mutating():
+    def __init__(self, config):
+        self.config = config
+
+    def aggregate_host(self, payload, prevtime, currtime, hostname=None):
+        return {"count": 1}
+
+    def aggregate_group(self, payload):
+        return {"count": sum(item.pop("count") for item in payload)}
+'''
+
+
+def test_hierarchy_levels_get_own_payload(tmp_path, monkeypatch, task):
+    (tmp_path / "mutating.py").write_text(MUTATING_PLUGIN)
+    monkeypatch.setenv("PLUGINS_PATH", str(tmp_path))
+    servicer = aggregator.Aggregator()
+    payload = msgpack.packb({"count": 1})
+    groups = [aggregator_pb2.AggregateSubGroup(name=dc, hosts=["h1", "h2"], payload=[payload] * 2)
+              for dc in ("dc1", "dc2")]
+    request = aggregator_pb2.AggregateHierarchyRequest(task=task, class_name="Mutating", groups=groups, per_host=True)
+    results = servicer.AggregateHierarchy(request, Context()).results
+    assert [(r.meta["type"], r.error, msgpack.unpackb(r.result, raw=False) if r.result else None) for r in results] == \
+        [("host", "", {"count": 1})] * 2 + [("datacenter", "", {"count": 2})] + \
+        [("host", "", {"count": 1})] * 2 + [("datacenter", "", {"count": 2})] + [("metahost", "", {"count": 4})]
+
+
+def test_group_methods_stats(servicer, task):
+    result = host_result(servicer, task, b"api.2xx 60\napi_timings 1 2 3")
+    group = aggregator_pb2.AggregateGroupRequest(task=task, class_name="Multimetrics", payload=[result] * 2)
+    partial = servicer.AggregatePartial(group, Context()).result
+    partials = aggregator_pb2.AggregateGroupRequest(task=task, class_name="Multimetrics", payload=[partial] * 2)
+    merged = servicer.MergePartials(partials, Context()).result
+    final = aggregator_pb2.AggregateGroupRequest(task=task, class_name="Multimetrics", payload=[merged])
+    assert msgpack.unpackb(servicer.AggregateFinalize(final, Context()).result, raw=False)["api.2xx"] == 4.0
+    assert msgpack.unpackb(servicer.AggregateGroupStream(iter([group, group]), Context()).result,
+                           raw=False)["api.2xx"] == 4.0
+
+    servicer.Profile(aggregator_pb2.ProfileRequest(class_name="Multimetrics"), Context())
+    groups = [aggregator_pb2.AggregateSubGroup(name="dc1", hosts=["h1", "h2"], payload=[result] * 2)]
+    request = aggregator_pb2.AggregateHierarchyRequest(task=task, class_name="Multimetrics", groups=groups,
+                                                       per_host=True)
+    assert len(servicer.AggregateHierarchy(request, Context()).results) == 4
+    assert "1 of 1 calls of Multimetrics are profiled" in servicer.profiler.report()
+
+    stats = json.loads(servicer.Stats(aggregator_pb2.StatsRequest(), Context()).stats)
+    assert stats["load_timings"]["multi_metrics"] > 0
+    phases = {"config", "unpack", "plugin", "pack", "total"}
+    for method in ("AggregatePartial", "MergePartials", "AggregateFinalize", "AggregateHierarchy"):
+        assert set(stats["latency"][method]["Multimetrics"]) == phases, method
+        assert set(stats["bytes"][method]["Multimetrics"]) == {"payload", "result"}, method
+    stream = stats["latency"]["AggregateGroupStream"]["Multimetrics"]
+    assert set(stream) == phases | {"stream"}
+    assert all(view["count"] == 1 for view in stream.values())
+    assert stats["bytes"]["AggregateGroupStream"]["Multimetrics"]["payload"]["sum"] == 4 * len(result)
+
+
+def test_pool_restarted_after_killed_process(task):
+    servicer = aggregator.PoolAggregator(2, 4)
+    request = aggregator_pb2.AggregateHostRequest(task=task, class_name="Multimetrics", payload=b"api.2xx 60")
+    try:
+        assert msgpack.unpackb(servicer.AggregateHost(request, Context()).result, raw=False) == {"api.2xx": 1.0}
+        broken = servicer.pool
+        os.kill(next(iter(broken._processes)), signal.SIGKILL)
+
+        # the call which finds the pool broken fails, the pool is replaced
+        context = Context()
+        deadline = time.time() + 30
+        while servicer.pool is broken and time.time() < deadline:
+            try:
+                servicer.AggregateHost(request, context)
+            except Exception:  # pylint: disable=broad-except
+                assert context.code == grpc.StatusCode.UNAVAILABLE
+        assert servicer.pool is not broken
+        assert context.code == grpc.StatusCode.UNAVAILABLE
+
+        for _ in range(4):
+            assert msgpack.unpackb(servicer.AggregateHost(request, Context()).result, raw=False) == {"api.2xx": 1.0}
+        # queue slots of the failed call are released
+        assert servicer.busy == 0
+    finally:
+        servicer.pool.shutdown()
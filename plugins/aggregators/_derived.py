@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Derived metrics of the aggregated result, shared by aggregators.
+Metrics are grouped by prefix (name without the last dot separated part),
+every spec adds metric `prefix.name` for prefixes of metrics which contain its pattern.
+It is not a plugin itself (name starts with `_`) and is imported by plugins from the plugins path.
+"""
+import bisect
+import itertools
+
+
+def _split(metric):
+    """Prefix and the last part of the metric name, the last part is None for names without dots"""
+    prefix, sep, last = metric.rpartition('.')
+    if not sep:
+        return metric, None
+    return prefix, last
+
+
+def _percentage(result, prefix, base_key, all_key):
+    """Percent of base in all as get_prc calculates it"""
+    try:
+        base = result['%s.%s' % (prefix, base_key)]
+    except KeyError:
+        # If there is no metric with base value, there 0% base in all
+        return 0
+
+    try:
+        total = result['%s.%s' % (prefix, all_key)]
+    except KeyError:
+        # If there is no metric with all value, there 100% base in all
+        return 100
+
+    if total < base:
+        return 100
+    return round(base * 100.0 / total, 2)
+
+
+def _sum(result, prefix, keys):
+    """Sum of present metrics, None if there is no one"""
+    values = [result[name] for name in ('%s.%s' % (prefix, key) for key in keys) if name in result]
+    if not values:
+        return None
+    return sum(values)
+
+
+def _ratio(result, prefix, numerator, denominator):
+    """Ratio of metrics, None if any of them is missing or denominator is zero"""
+    try:
+        num = result['%s.%s' % (prefix, numerator)]
+        den = result['%s.%s' % (prefix, denominator)]
+    except KeyError:
+        return None
+    if not den:
+        return None
+    return num / den
+
+
+def _compile_expression(expression):
+    """`a/b` - ratio of metrics, `a+b+c` - sum of metrics"""
+    if '/' in expression:
+        parts = [p.strip() for p in expression.split('/')]
+        if len(parts) != 2 or not all(parts):
+            raise ValueError("Bad ratio expression '%s'" % expression)
+        return _ratio, tuple(parts)
+
+    parts = [p.strip() for p in expression.split('+')]
+    if not all(parts):
+        raise ValueError("Bad sum expression '%s'" % expression)
+    return _sum, (parts, )
+
+
+class _Index():
+    """
+    Metrics of the result grouped by prefix, built once and updated by derived metrics.
+    Prefixes are searched for patterns in one string of all of them
+    """
+
+    def __init__(self, result):
+        self.size = len(result)
+        # prefix -> {last part: position in the result}, positions are increasing
+        self.prefixes = prefixes = {}
+        for pos, metric in enumerate(result):
+            prefix, last = _split(metric)
+            entries = prefixes.get(prefix)
+            if entries is None:
+                prefixes[prefix] = {last: pos}
+            else:
+                entries[last] = pos
+        # distinct last parts
+        self.lasts = {last for entries in prefixes.values() for last in entries}
+        self.lasts.discard(None)
+        self.names = None
+        self.joined = None
+        self.offsets = None
+
+    def add(self, metric):
+        prefix, last = _split(metric)
+        entries = self.prefixes.get(prefix)
+        if entries is None:
+            entries = self.prefixes[prefix] = {}
+            self.names = None
+        entries[last] = self.size
+        self.size += 1
+        if last is not None:
+            self.lasts.add(last)
+
+    def _search(self, needle):
+        """Prefixes which contain needle, names are separated by new lines which are not in metric names"""
+        if self.names is None:
+            self.names = list(self.prefixes)
+            self.joined = '\n'.join(self.names) + '\n'
+            self.offsets = [0]
+            self.offsets.extend(itertools.accumulate(len(name) + 1 for name in self.names))
+        found = []
+        start = self.joined.find(needle)
+        while start >= 0:
+            idx = bisect.bisect_right(self.offsets, start) - 1
+            if idx >= len(self.names):
+                break  # empty needle at the end
+            found.append(self.names[idx])
+            start = self.joined.find(needle, self.offsets[idx + 1])
+        return found
+
+    def matching(self, pattern):
+        """Prefixes of metrics which contain pattern, in order of the first such metric in the result"""
+        first = {}
+        for prefix in self._search(pattern):
+            first[prefix] = next(iter(self.prefixes[prefix].values()))
+
+        if '.' in pattern:
+            # pattern spans the prefix and the last part (without dots) by its last dot
+            head, _, tail = pattern.rpartition('.')
+            candidates = self._search(head + '\n') if head else list(self.prefixes)
+            lasts = {last for last in self.lasts if last.startswith(tail)}
+        else:
+            lasts = {last for last in self.lasts if pattern in last}
+            candidates = list(self.prefixes) if lasts else []
+
+        for prefix in candidates:
+            if prefix in first:
+                continue
+            for last, pos in self.prefixes[prefix].items():
+                if last in lasts:
+                    first[prefix] = pos
+                    break
+        return sorted(first, key=first.get)
+
+
+class Derived():
+    """
+    Derived metrics compiled once from config:
+    get_prc: {pattern: "base/all"} - `prefix.err_prc`, percent of base in all
+    derived: {pattern: {name: "a/b" or "a+b+c"}} - `prefix.name`, ratio or sum of metrics
+    Specs are evaluated in order, so they may use results of the previous ones
+    """
+
+    def __init__(self, get_prc=None, derived=None):
+        self.specs = []
+        for pattern, spec in (get_prc or {}).items():
+            base_key, all_key = spec.split('/')
+            self.specs.append((pattern, "err_prc", _percentage, (base_key, all_key)))
+        for pattern, metrics in (derived or {}).items():
+            for name, expression in metrics.items():
+                func, args = _compile_expression(expression)
+                self.specs.append((pattern, name, func, args))
+
+    def __bool__(self):
+        return bool(self.specs)
+
+    def apply(self, result):
+        """Add derived metrics to the result"""
+        index = _Index(result)
+        for pattern, name, func, args in self.specs:
+            calc_result = {}
+            for prefix in index.matching(pattern):
+                value = func(result, prefix, *args)
+                if value is not None:
+                    calc_result['%s.%s' % (prefix, name)] = value
+            for metric in calc_result:
+                if metric not in result:
+                    index.add(metric)
+            result.update(calc_result)
+        return result
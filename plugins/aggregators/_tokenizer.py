@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+Tokenizer of plugin payloads with lines of `name value value ...`,
+shared by aggregators. It is not a plugin itself (name starts with `_`)
+and is imported by plugins from the plugins path.
+"""
+
+# payload of printable ascii, tabs and new lines is split as bytes without decoding
+_PLAIN = bytes(range(0x20, 0x7f)) + b'\t\n\r'
+
+
+def is_plain(payload):
+    return not payload.translate(None, _PLAIN)
+
+
+def lines(payload):
+    """
+    Iterate over (name, values) of not empty lines, name is decoded, values are bytes.
+    Name is separated from values by the first spaces or tabs, values may end with whitespaces
+    """
+    if is_plain(payload):
+        for line in payload.splitlines():
+            parts = line.split(None, 1)
+            if parts:
+                yield parts[0].decode('ascii'), parts[1] if len(parts) > 1 else b''
+        return
+
+    for raw_line in payload.splitlines():
+        line = raw_line.decode('ascii', errors='ignore').strip().replace('\t', ' ')
+        if not line:
+            continue
+        name, _, values = line.partition(' ')
+        # whitespaces which bytes do not split on are removed from values too
+        yield name.strip(), ' '.join(values.split()).encode('ascii')
+
+
+def split_floats(values):
+    """
+    Floats of bytes of values separated by whitespaces, parsed one by one.
+    np.fromstring is not faster on lines of metrics and parses whitespaces only as [-1.0]
+    """
+    return list(map(float, values.split()))
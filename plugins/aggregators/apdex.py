@@ -1,32 +1,33 @@
 #!/usr/bin/env python3
+import _tokenizer
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-def is_apdex(name):
-    return "_timings" in name
+# use numpy to classify lines with at least such count of values
+NUMPY_THRESHOLD = 32
 
 
-class _ApdexItem(object):
-    def __init__(self, satisfied, tolerating):
-        # limits
-        self.satisfied = satisfied
-        self.tolerating = tolerating
-
-        # values
-        self.satcount = 0
-        self.tolcount = 0
-        self.restcount = 0
+def is_apdex(name):
+    return "_timings" in name
 
-    def push(self, values):
-        for value in values:
-            if value < self.satisfied:
-                self.satcount += 1
-            elif value < self.tolerating:
-                self.tolcount += 1
-            else:
-                self.restcount += 1
 
-    def value(self):
-        return (self.satcount, self.tolcount, self.restcount)
+def parse_packed(values):
+    """
+    Values and counts of the packed form `value@count value@count`,
+    entries without count or value are skipped as Multimetrics does
+    """
+    parsed = []
+    counts = []
+    for item in values.split():
+        value, sep, count = item.partition(b'@')
+        if not sep or not value:
+            continue
+        parsed.append(float(value))
+        counts.append(float(count))
+    return parsed, counts
 
 
 def calc_apdex(sat, tol, rest):
@@ -34,70 +35,128 @@ def calc_apdex(sat, tol, rest):
 
 
 class Apdex(object):
+    # instance keeps no state between calls and may be reused
+    reusable = True
+    # partial and merge iterate their argument once
+    lazy_payload = True
+
     def __init__(self, config):
         self.satisfied = config["satisfied"]
         self.tolerating = config["tolerating"]
         if self.tolerating < self.satisfied:
             raise ValueError("tolerating must be less than satisfied")
+        if np is not None:
+            self.thresholds = np.array([self.satisfied, self.tolerating], dtype=np.float64)
 
         # recalculate to msec for example
-        factor = config.get("factor", 1)
-        if factor == 1:
-            self.factor = float
-        else:
-            self.factor = lambda x: factor * float(x)
+        self.factor = config.get("factor", 1)
+
+    def classify(self, values, counts=None):
+        """
+        Counts of satisfied, tolerating and frustrated values,
+        `counts` are counts of values in the packed form
+        """
+        if np is not None and len(values) >= NUMPY_THRESHOLD:
+            values = np.array(values, dtype=np.float64)
+            if self.factor != 1:
+                values *= self.factor
+            # index of the bucket: 0 - less than satisfied, 1 - less than tolerating, 2 - the rest
+            buckets = np.searchsorted(self.thresholds, values, side='right')
+            return np.bincount(buckets, weights=counts, minlength=3).tolist()
+
+        sat, tol, factor = self.satisfied, self.tolerating, self.factor
+        # packed counts are floats as numpy weights are
+        result = [0, 0, 0] if counts is None else [0.0, 0.0, 0.0]
+        for idx, value in enumerate(values):
+            count = counts[idx] if counts is not None else 1
+            value *= factor
+            if value < sat:
+                result[0] += count
+            elif value < tol:
+                result[1] += count
+            else:
+                result[2] += count
+        return result
 
     def aggregate_host(self, payload, prevtime, currtime, hostname=None):
-        factor = self.factor
-        sat, tol = self.satisfied, self.tolerating
+        """Payload lines: `name_timings value value` or packed `@name_timings value@count`"""
         result = {}
-        for raw_line in (i for i in payload.splitlines() if is_apdex(i)):
-            line = raw_line.decode('ascii', errors='ignore')
-            name, _, metrics_as_strings = line.partition(" ")
+        for name, values in _tokenizer.lines(payload):
+            if not is_apdex(name):
+                continue
 
             # no value for this metric has stored yet and no value now
             if name not in result:
-                result[name] = _ApdexItem(sat, tol)
+                result[name] = [0, 0, 0]
 
-            if not metrics_as_strings:
+            if not values:
                 continue
 
             try:
-                metrics_as_values = map(factor, metrics_as_strings.split())
-                result[name].push(metrics_as_values)
+                if name[0] == '@':
+                    parsed, counts = parse_packed(values)
+                else:
+                    parsed, counts = _tokenizer.split_floats(values), None
             except ValueError as err:
-                raise Exception("Unable to parse %s: %s" % (raw_line, err))
-        return tuple((k, v.value()) for (k, v) in result.iteritems())
+                raise Exception("Unable to parse %s %s: %s" % (name, values.decode('ascii'), err))
+            total = result[name]
+            sat, tol, rest = self.classify(parsed, counts)
+            total[0] += sat
+            total[1] += tol
+            total[2] += rest
+        return tuple((k, tuple(v)) for (k, v) in result.items())
 
     def aggregate_group(self, payload):
         """payload: []("metric_name", (<sat>, <tol>, <res>))"""
+        return self.finalize(self.partial(payload))
+
+    def partial(self, payload):  # pylint: disable=no-self-use
+        """payload: []("metric_name", (<sat>, <tol>, <res>)) -> {"metric_name": [<sat>, <tol>, <res>]}"""
         res = {}
         for payload_from_one in payload:
             for metric_name, values in payload_from_one:
-                if metric_name in res:
-                    fast = res[metric_name]
-                    res[metric_name] = tuple(i + j for i, j in zip(fast, values))
+                total = res.get(metric_name)
+                if total is None:
+                    res[metric_name] = list(values)
                 else:
-                    res[metric_name] = values
+                    total[0] += values[0]
+                    total[1] += values[1]
+                    total[2] += values[2]
+        return res
+
+    def merge(self, partials):
+        """partials: []{"metric_name": [<sat>, <tol>, <res>]}"""
+        return self.partial(p.items() for p in partials)
 
+    def finalize(self, state):  # pylint: disable=no-self-use
         apdex_res = {}
-        for k, v in res.iteritems():
+        for k, v in state.items():
+            # hosts report the metric without values as zero counts, apdex is undefined for it
+            if not sum(v):
+                continue
+            if k[0] == '@':
+                k = k[1:]  # make timings name valid
             apdex_res[k] = calc_apdex(*v)
         return apdex_res
 
 
 if __name__ == '__main__':
-    payload = "blabla_timings " + ' '.join(map(str, xrange(0, 100)))
-    payload += "\nblabla_timings " + ' '.join(map(str, xrange(0, 100)))
-    payload += "\nb_timings " + ' '.join(map(str, xrange(0, 300)))
+    payload = b"blabla_timings " + b' '.join(b'%d' % i for i in range(0, 100))
+    payload += b"\nblabla_timings " + b' '.join(b'%d' % i for i in range(0, 100))
+    payload += b"\nb_timings " + b' '.join(b'%d' % i for i in range(0, 300))
+    payload += b"\n@p_timings 10@30 50@60 100@10 @5 7"
+    payload += b"\nempty_timings\n@empty_timings @5"
     config = {"satisfied": 30, "tolerating": 90}
     apdex = Apdex(config)
     t = apdex.aggregate_host(payload, 0, 100)
     res = t[0]
     assert "blabla_timings" in res, res
     assert res[1] == (60, 120, 20), res[1]
+    assert t[2][1] == (30, 60, 10), t[2][1]
 
     final = apdex.aggregate_group([t, t, t])
     assert "blabla_timings" in final, final
     assert final["blabla_timings"] == 0.6, final["blabla_timings"]
     assert final["b_timings"] == 0.2, final["b_timings"]
+    assert final["p_timings"] == 0.6, final["p_timings"]
+    assert "empty_timings" not in final, final
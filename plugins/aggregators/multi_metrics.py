@@ -1,7 +1,34 @@
 #!/usr/bin/env python
+import array
+import collections
+import itertools
 import logging
+import math
+import re
+import sys
 
+import msgpack
+
+import _derived
+import _tokenizer
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+FORBIDDEN_SYMBOLS = re.compile(r'[<>;\\]')
+# separators of timings values in addition to whitespaces
+TIMINGS_SEPARATORS = bytes.maketrans(b',-:', b'   ')
 DEFAULT_QUANTILE_VALUES = [75, 90, 93, 94, 95, 96, 97, 98, 99]
+# use numpy for quantiles of timings with at least such count of distinct values
+NUMPY_QUANTILES_THRESHOLD = 512
+# use numpy to merge timings of a metric with at least such count of entries from all hosts
+NUMPY_MERGE_THRESHOLD = 512
+# fold timings of a metric collected from states in to one typed entry at such count of them
+TIMINGS_FOLD_SIZE = 64
+# msgpack ext type of typed timings: little-endian float64 values followed by float64 counts
+TIMINGS_EXT = 1
 
 
 def _add_timings(container, name, timings_value):
@@ -16,8 +43,8 @@ def _add_timings(container, name, timings_value):
         tim_dict = container[name]
 
     if name[0] == '@':
-        if '@' in timings_value:
-            timings_value, count = timings_value.split("@")
+        if b'@' in timings_value:
+            timings_value, count = timings_value.split(b"@")
             if not timings_value:  # skip entries like '@25' treat as parses errors
                 return
         else:
@@ -36,6 +63,282 @@ def _add_timings(container, name, timings_value):
         tim_dict[key] = count
 
 
+def _add_timings_line(tim_dict, timings_values):
+    """
+    Bulk version of the _add_timings for the whole line of not packed values.
+    Returns False if the line has not a float value, such line should be parsed by the _add_timings
+    """
+    try:
+        values = _tokenizer.split_floats(timings_values)
+    except ValueError:
+        return False
+    for key, count in collections.Counter(values).items():
+        try:
+            tim_dict[key] += count
+        except KeyError:
+            tim_dict[key] = float(count)
+    return True
+
+
+def _np_add_timings(tim_dict, name, timings_values):
+    """
+    Vectorized version of the _add_timings for the whole line of values.
+    Returns False if the line has entries which _add_timings
+    skips or fails on, such line should be parsed by the _add_timings
+    """
+    tokens = timings_values.split()
+    if not tokens:
+        return True
+
+    try:
+        if name[0] == '@':
+            # every entry must have exactly one '@' and both parts not empty
+            if timings_values.count(b'@') != len(tokens) or not all(b'@' in tmn for tmn in tokens):
+                return False
+            pairs = timings_values.replace(b'@', b' ').split()
+            if len(pairs) != 2 * len(tokens):
+                return False
+            pairs = np.array(pairs, dtype=np.float64).reshape(-1, 2)
+            values = pairs[:, 0]
+        else:
+            values = np.array(tokens, dtype=np.float64)
+    except ValueError:
+        return False
+    if np.isnan(values).any():
+        return False
+
+    if name[0] == '@':
+        keys, inverse = np.unique(values, return_inverse=True)
+        counts = np.bincount(inverse.ravel(), weights=pairs[:, 1], minlength=len(keys))
+    else:
+        keys, counts = np.unique(values, return_counts=True)
+
+    for key, count in zip(keys.tolist(), counts.tolist()):
+        try:
+            tim_dict[key] += count
+        except KeyError:
+            tim_dict[key] = float(count)
+    return True
+
+
+def _pack_timings(timings):
+    """Typed form of timings dict: msgpack ext with arrays of values and counts"""
+    data = array.array('d', timings.keys())
+    data.extend(timings.values())
+    if sys.byteorder != 'little':
+        data.byteswap()
+    return msgpack.ExtType(TIMINGS_EXT, data.tobytes())
+
+
+def _unpack_timings(ext):
+    """Timings dict from the typed form"""
+    data = array.array('d')
+    data.frombytes(ext.data)
+    if sys.byteorder != 'little':
+        data.byteswap()
+    size = len(data) // 2
+    return dict(zip(data[:size], data[size:]))
+
+
+def _is_typed(timings):
+    return isinstance(timings, msgpack.ExtType)
+
+
+def _coarsen_timings(timings, limit):
+    """
+    Round timings values to fewer significant digits until there are at most `limit` of them
+    or only one digit is left, counts are kept. Returns timings and count of distinct values merged by rounding
+    """
+    size = len(timings)
+    for digits in range(6, 0, -1):
+        coarse = {}
+        for key, count in timings.items():
+            key = float('%.*g' % (digits, key))
+            try:
+                coarse[key] += count
+            except KeyError:
+                coarse[key] = count
+        if len(coarse) <= limit:
+            break
+    return coarse, size - len(coarse)
+
+
+def _merge_timings(timings, typed=False):
+    """
+    Sum counts of the same timings values from the list of dicts or their typed forms,
+    the result is dict or its typed form if `typed`
+    """
+    has_typed = any(map(_is_typed, timings))
+    if np is not None:
+        if has_typed:
+            size = sum(len(t.data) // 16 if _is_typed(t) else len(t) for t in timings)
+        else:
+            size = sum(map(len, timings))
+        if size >= NUMPY_MERGE_THRESHOLD:
+            merged = _np_merge_typed_timings(timings) if has_typed else _np_merge_timings(timings, size)
+            if merged is not None:
+                keys, counts = merged
+                if typed:
+                    return msgpack.ExtType(TIMINGS_EXT, np.concatenate(merged).astype('<f8').tobytes())
+                return dict(zip(keys.tolist(), counts.tolist()))
+
+    if has_typed:
+        timings = [_unpack_timings(t) if _is_typed(t) else t for t in timings]
+    result = dict(timings[0])
+    for item in timings[1:]:
+        for tmk, val in item.items():
+            try:
+                result[tmk] += val
+            except KeyError:
+                result[tmk] = val
+    return _pack_timings(result) if typed else result
+
+
+def _np_merge_timings(timings, size):
+    """
+    Vectorized version of the _merge_timings: grouped sum of concatenated (value, count) arrays.
+    Counts of the same value are added in the order of dicts as the python loop does.
+    Returns arrays of values and counts or None for timings with nan values, which are distinct keys of dicts
+    """
+    keys = np.fromiter(itertools.chain.from_iterable(timings), dtype=np.float64, count=size)
+    if np.isnan(keys).any():
+        return None
+    counts = np.fromiter(itertools.chain.from_iterable(map(dict.values, timings)), dtype=np.float64, count=size)
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inverse.ravel(), weights=counts, minlength=len(keys))
+
+
+def _np_merge_typed_timings(timings):
+    """_np_merge_timings of timings with typed forms, their arrays are used without building dicts"""
+    keys = []
+    counts = []
+    for typed, items in itertools.groupby(timings, key=_is_typed):
+        if typed:
+            for item in items:
+                data = np.frombuffer(item.data, dtype='<f8')
+                size = len(data) // 2
+                keys.append(data[:size])
+                counts.append(data[size:])
+        else:
+            # consecutive dicts are read at once
+            items = list(items)
+            size = sum(map(len, items))
+            keys.append(np.fromiter(itertools.chain.from_iterable(items), dtype=np.float64, count=size))
+            counts.append(np.fromiter(itertools.chain.from_iterable(map(dict.values, items)),
+                                      dtype=np.float64, count=size))
+    keys = np.concatenate(keys)
+    if np.isnan(keys).any():
+        return None
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inverse.ravel(), weights=np.concatenate(counts), minlength=len(keys))
+
+
+class _Histogram():
+    """
+    Log-linear histogram of timings: every power of two range
+    [min * 2^e, min * 2^(e+1)) is split in to `sub_buckets` linear buckets,
+    so the middle of a bucket differs from any its value by less than 1/(2*sub_buckets).
+    Bucket 0 counts values less than `min`, the last bucket - not less than `max`.
+    Compact form is [offset, counts] where counts[i] is the count of the bucket offset + i
+    """
+
+    def __init__(self, config):
+        self.min = float(config.get("min", 1e-6))
+        self.max = float(config.get("max", 1e6))
+        self.sub_buckets = int(config.get("sub_buckets", 64))
+        if not 0 < self.min < self.max or self.sub_buckets < 1:
+            raise ValueError("histogram requires 0 < min < max and sub_buckets > 0")
+        ranges = int(math.ceil(math.log2(self.max / self.min)))
+        self.overflow = ranges * self.sub_buckets + 1
+        self.size = self.overflow + 1
+
+    def index(self, value):
+        "Bucket index of the value"
+        if not value >= self.min:
+            return 0
+        if value >= self.max:
+            return self.overflow
+        mantissa, exp = math.frexp(value / self.min)  # mantissa in [0.5, 1)
+        idx = (exp - 1) * self.sub_buckets + int((2 * mantissa - 1) * self.sub_buckets) + 1
+        return min(idx, self.overflow - 1)
+
+    def _np_indexes(self, values):
+        regular = (values >= self.min) & (values < self.max)
+        mantissa, exp = np.frexp(np.where(regular, values, self.min) / self.min)
+        idx = (exp - 1) * self.sub_buckets + ((2 * mantissa - 1) * self.sub_buckets).astype(np.int64) + 1
+        idx = np.minimum(idx, self.overflow - 1)
+        return np.where(regular, idx, np.where(values >= self.max, self.overflow, 0))
+
+    def value(self, idx):
+        "Middle of the bucket"
+        if idx == 0:
+            return self.min
+        if idx >= self.overflow:
+            return self.max
+        exp, sub = divmod(idx - 1, self.sub_buckets)
+        width = self.min * 2 ** exp / self.sub_buckets
+        return self.min * 2 ** exp + width * (sub + 0.5)
+
+    @staticmethod
+    def _compact(dense):
+        nonzero = [i for i, count in enumerate(dense) if count]
+        if not nonzero:
+            return [0, []]
+        low, high = nonzero[0], nonzero[-1]
+        # integer counts are packed by msgpack much tighter than floats
+        return [low, [int(c) if float(c).is_integer() else c for c in dense[low:high + 1]]]
+
+    def from_timings(self, timings):
+        "Convert dict {'timings_value': 'values_count', ...} in to compact form"
+        if np is not None:
+            values = np.fromiter(timings.keys(), dtype=np.float64, count=len(timings))
+            counts = np.fromiter(timings.values(), dtype=np.float64, count=len(timings))
+            dense = np.bincount(self._np_indexes(values), weights=counts, minlength=self.size)
+            return self._compact(dense.tolist())
+
+        dense = [0.0] * self.size
+        for value, count in timings.items():
+            dense[self.index(value)] += count
+        return self._compact(dense)
+
+    def merge(self, hists):
+        "Merge list of compact forms by vector addition"
+        if np is not None:
+            dense = np.zeros(self.size)
+            for offset, counts in hists:
+                dense[offset:offset + len(counts)] += counts
+            return self._compact(dense.tolist())
+
+        dense = [0.0] * self.size
+        for offset, counts in hists:
+            for idx, count in enumerate(counts, offset):
+                dense[idx] += count
+        return self._compact(dense)
+
+    def quantiles(self, hist, quantile):
+        "Quantiles (sorted list of percents) from cumulative counts of compact form"
+        offset, counts = hist
+        total_count = sum(counts)
+        value = self.value(offset)
+        result = [value] * len(quantile)
+
+        pos = 0
+        last = len(counts) - 1
+        sumidx = counts[0]
+        for idx, quant in enumerate(quantile):
+            if quant < 100:
+                index = int(total_count / 100 * quant)
+                while sumidx < index and pos < last:
+                    pos += 1
+                    sumidx += counts[pos]
+                if index <= sumidx:
+                    value = self.value(offset + pos)
+            else:
+                value = self.value(offset + last)
+            result[idx] = value
+        return result
+
+
 class Multimetrics():
     """
     General metrics count:
@@ -55,6 +358,11 @@ class Multimetrics():
     @uploader_timings_request_post_upload-url 0.001@300 0.002@3 0.001@12
     """
 
+    # instance keeps no state between calls and may be reused
+    reusable = True
+    # partial and merge iterate their argument once
+    lazy_payload = True
+
     def __init__(self, config):
         self.quantile = list(config.get("values", DEFAULT_QUANTILE_VALUES))
         self.quantile.sort()
@@ -68,9 +376,34 @@ class Multimetrics():
         # get prc. By default - No. Format: { ext_services: error/info }
         # get prc of errors in info from metrics which contents 'ext_services'
         self.get_prc = config.get("get_prc", False)
+        # derived metrics. By default - No. Format: { api: { total: 2xx+3xx+4xx+5xx, ok: 2xx/total } }
+        # add metrics with sum or ratio of metrics with the same prefix as metrics which contents 'api'
+        self.derived = _derived.Derived(self.get_prc, config.get("derived"))
+        # bucket timings in to log-linear histogram. By default - No.
+        # Format: { min: 0.000001, max: 1000000, sub_buckets: 64 } or `true` for defaults
+        histogram = config.get("histogram", False)
+        self.histogram = None
+        if histogram:
+            self.histogram = _Histogram(histogram if isinstance(histogram, dict) else {})
+        # return host timings in typed form (msgpack ext) instead of dict. By default - No.
+        # All aggregators of the task must support it, histogram has its own compact form
+        self.typed_timings = bool(config.get("typed_timings", False)) and self.histogram is None
+        # caps of distinct metrics of a result and distinct values of a timings metric. By default - No.
+        # Metrics over the cap are dropped, timings values are rounded to fewer significant digits
+        self.max_metrics = int(config.get("max_metrics", 0))
+        self.max_timings_values = int(config.get("max_timings_values", 0))
+        # counters of dropped metrics and rounded timings values: `<overflow_metric>.metrics|values`
+        self.overflow_metric = config.get("overflow_metric", "overflow")
+        self.overflow_names = ("%s.metrics" % self.overflow_metric, "%s.values" % self.overflow_metric)
 
         self.log = config.get("logger", logging.getLogger())
 
+        # timings parsing engine: python or numpy. default 'python'
+        self.engine = config.get("engine", "python")
+        if self.engine == "numpy" and np is None:
+            self.log.warning("numpy is not available, fallback to the python engine")
+            self.engine = "python"
+
     def is_timings(self, name):
         "Check metric name against is timings"
         return name[0] == '@' or self.timings_is in name
@@ -83,32 +416,35 @@ class Multimetrics():
             delta = 1.0
 
         result = {}
-        for raw_line in payload.splitlines():
-            line = raw_line.decode('ascii', errors='ignore')
-            line = line.strip().replace('\t', ' ')
-            if not line:
-                continue
-
-            name, _, metrics_as_strings = map(lambda x: x.strip(), line.partition(' '))
-            if any(c in name for c in "<>;\\"):
+        dropped = set()
+        for name, values in _tokenizer.lines(payload):
+            if FORBIDDEN_SYMBOLS.search(name):
                 self.log.error("hostname=%s Name of metric contains forbidden symbols: '<>;\\'", hostname)
                 continue
+            if self.max_metrics and len(result) >= self.max_metrics and name not in result:
+                dropped.add(name)
+                continue
 
             try:
                 if self.is_timings(name):
-                    metrics_as_strings = metrics_as_strings.replace(',', ' ').replace('-', ' ').replace(':', ' ')
-                    if not metrics_as_strings:
+                    if not values:
                         continue
+                    # values are parsed as bytes, float and numpy take them without decoding
+                    timings_values = values.translate(TIMINGS_SEPARATORS)
 
                     if name not in result:
                         result[name] = {}
 
-                    for tmn in metrics_as_strings.split():
+                    if self.engine == "numpy" and _np_add_timings(result[name], name, timings_values):
+                        continue
+                    if name[0] != '@' and _add_timings_line(result[name], timings_values):
+                        continue
+                    for tmn in timings_values.split():
                         _add_timings(result, name, tmn)
                 else:
                     metrics_as_values = 0
-                    if metrics_as_strings:
-                        metrics_as_values = sum(map(float, metrics_as_strings.split()))
+                    if values:
+                        metrics_as_values = sum(_tokenizer.split_floats(values))
 
                     if self.rps:
                         metrics_as_values /= delta
@@ -118,109 +454,184 @@ class Multimetrics():
                     except KeyError:
                         result[name] = metrics_as_values
             except Exception as err:  # pylint: disable=broad-except
-                self.log.error("hostname=%s Unable to parse %s: %s", hostname, line, err)
+                self.log.error("hostname=%s Unable to parse %s %s: %s", hostname, name, values.decode('ascii'), err)
+
+        self._limit(result, len(dropped), hostname)
+        if self.histogram is not None:
+            for name, value in result.items():
+                if isinstance(value, dict):
+                    result[name] = self.histogram.from_timings(value)
+        elif self.typed_timings:
+            for name, value in result.items():
+                if isinstance(value, dict):
+                    result[name] = _pack_timings(value)
         return result
 
     def aggregate_group(self, payload):
         """ Payload is list of dict[string][]float"""
         if not payload:
             raise Exception("No data to aggregate")
+        return self.finalize(self.partial(payload))
 
-        names_of_metrics = set()
-        for i in payload:
-            names_of_metrics.update(i.keys())
-        result = {}
+    def partial(self, payload):
+        """
+        Merge list of aggregate_host results in to mergeable state.
+        State has the same form as aggregate_host result
+        """
+        return self.merge(payload)
 
-        for metric in names_of_metrics:
-            if self.is_timings(metric):
-                agg_timings = {}
-                count = 0.0
-                for item in payload:
-                    for tmk, val in item.get(metric, {}).items():
-                        try:
-                            agg_timings[tmk] += val
-                        except KeyError:
-                            agg_timings[tmk] = val
-                        count += val
-
-                if not agg_timings:
+    def merge(self, partials):
+        """
+        Merge list of states in one pass over them, states are not modified.
+        Timings of every metric are collected from states and merged by folds in to typed form
+        """
+        state = {}
+        timings = {}
+        dropped = set()
+        for item in partials:
+            for metric, value in item.items():
+                if metric in timings:
+                    values = timings[metric]
+                    values.append(value)
+                    if len(values) >= TIMINGS_FOLD_SIZE and self.histogram is None:
+                        # counts are added in the same order, so folding does not change the sums
+                        timings[metric] = [_merge_timings(values, typed=True)]
                     continue
+                try:
+                    state[metric] += value
+                except KeyError:
+                    if self.max_metrics and len(state) >= self.max_metrics and metric not in self.overflow_names:
+                        dropped.add(metric)
+                        continue
+                    if self.is_timings(metric):
+                        timings[metric] = [value]
+                        value = None  # keep order of metrics, merged below
+                    state[metric] = value
+
+        for metric, values in timings.items():
+            if self.histogram is not None:
+                values = [_unpack_timings(v) if _is_typed(v) else v for v in values]
+                values = [self.histogram.from_timings(v) if isinstance(v, dict) else v for v in values]
+                state[metric] = self.histogram.merge(values)
+            else:
+                state[metric] = _merge_timings(values)
+        self._limit(state, len(dropped))
+        return state
 
+    def merge_frames(self, states):
+        """
+        Merge states of consecutive frames of the metahost for results over windows.
+        Metrics are rates per second with rps, they are averaged over the frames instead of summed
+        """
+        state = self.merge(states)
+        if self.rps and len(states) > 1:
+            for metric, value in state.items():
+                if not self.is_timings(metric) and metric not in self.overflow_names:
+                    state[metric] = value / len(states)
+        return state
+
+    def _limit(self, result, dropped, hostname=None):
+        """Apply cap of timings values to the result and count overflows in it"""
+        rounded = 0
+        if self.max_timings_values:
+            for name, value in result.items():
+                if isinstance(value, dict) and len(value) > self.max_timings_values:
+                    result[name], merged = _coarsen_timings(value, self.max_timings_values)
+                    rounded += merged
+        if not dropped and not rounded:
+            return
+        self.log.warning("hostname=%s Cardinality overflow: %d metrics dropped, %d timings values rounded",
+                         hostname, dropped, rounded)
+        for name, count in zip(self.overflow_names, (dropped, rounded)):
+            if count:
+                result[name] = result.get(name, 0) + count
+
+    def finalize(self, state):
+        """ Calculate quantiles and percentage from merged state """
+        result = {}
+        for metric, value in state.items():
+            if self.is_timings(metric):
+                if self.histogram is not None:
+                    if not value[1]:
+                        continue
+                    quantiles = [self.factor(v) for v in self.histogram.quantiles(value, self.quantile)]
+                else:
+                    if not value:
+                        continue
+                    quantiles = self.calculate_quantiles(value, sum(value.values()))
                 if metric[0] == '@':
                     metric = metric[1:]  # make timings name valid
-                result[metric] = self.calculate_quantiles(agg_timings, count)
+                result[metric] = quantiles
             else:
-                metric_sum = sum(item.get(metric, 0) for item in payload)
-                result[metric] = metric_sum
+                result[metric] = value
 
-        if self.get_prc:
-            self.calculate_percentage(result)
+        if self.derived:
+            self.derived.apply(result)
 
         return result
 
     def calculate_quantiles(self, timings, total_count):
         """
         Calculate quantiles from dict {'timings_value': 'values_count', ...}
+        All quantiles are found in one cumulative sweep over sorted timings
         """
+        if np is not None and len(timings) >= NUMPY_QUANTILES_THRESHOLD:
+            quantiles = self._np_calculate_quantiles(timings, total_count)
+            if quantiles is not None:
+                return quantiles
+        return self._py_calculate_quantiles(timings, total_count)
 
+    def _py_calculate_quantiles(self, timings, total_count):
         keys = sorted(timings.keys())
+        last = len(keys) - 1
         value = keys[0]
         quantiles = [value] * len(self.quantile)
 
+        pos = 0
+        sumidx = timings[value]
         for idx, quant in enumerate(self.quantile):
             if quant < 100:
                 index = int(total_count / 100 * quant)
-                sumidx = 0
-                for i in keys:
-                    sumidx += timings[i]
-                    if index <= sumidx:
-                        value = i
-                        break
+                # self.quantile is sorted, so index never decreases
+                while sumidx < index and pos < last:
+                    pos += 1
+                    sumidx += timings[keys[pos]]
+                if index <= sumidx:
+                    value = keys[pos]
             else:
                 value = keys[-1]
 
             quantiles[idx] = self.factor(value)
         return quantiles
 
-    def calculate_percentage(self, result):
-        """Get percentage one metric in other"""
-
-        for pattern in self.get_prc:
-            calc_result = {}
-            # prc_result = base * 100 / all , where base, all - last key in metric
-            base_key, all_key = self.get_prc[pattern].split('/')
-            for metric in result:
-                # Process only matching our pattern metrics
-                if pattern not in metric:
-                    continue
-                # Construct metric parts
-                metric_prefix = metric.rsplit('.', 1)[0]
-                metric_base = '%s.%s' % (metric_prefix, base_key)
-                metric_all = '%s.%s' % (metric_prefix, all_key)
-                metric_result = '%s.err_prc' % (metric_prefix)
-                # Do not process metric if we already have result
-                if metric_result in calc_result:
-                    continue
-
-                try:
-                    metric_base_value = result[metric_base]
-                except KeyError:
-                    # If there is no metric with base value, there 0% base in all
-                    calc_result[metric_result] = 0
-                    continue
-
-                try:
-                    metric_all_value = result[metric_all]
-                except KeyError:
-                    # If there is no metric with all value, there 100% base in all
-                    calc_result[metric_result] = 100
-                    continue
+    def _np_calculate_quantiles(self, timings, total_count):
+        """
+        Same as _py_calculate_quantiles but with searchsorted over prefix sums,
+        returns None for timings which numpy can not sort as python does
+        """
+        size = len(timings)
+        keys = np.fromiter(timings.keys(), dtype=np.float64, count=size)
+        if np.isnan(keys).any():
+            return None
+        counts = np.fromiter(timings.values(), dtype=np.float64, count=size)
+        order = np.argsort(keys)
+        keys = keys[order]
+        # cumsum adds sequentially, so prefix sums are the same as in the python sweep
+        prefix = np.cumsum(counts[order])
+
+        value = keys[0].item()
+        quantiles = [value] * len(self.quantile)
+        for idx, quant in enumerate(self.quantile):
+            if quant < 100:
+                index = int(total_count / 100 * quant)
+                pos = int(np.searchsorted(prefix, index, side='left'))
+                if pos < size:
+                    value = keys[pos].item()
+            else:
+                value = keys[-1].item()
 
-                if metric_all_value < metric_base_value:
-                    calc_result[metric_result] = 100
-                else:
-                    calc_result[metric_result] = round(metric_base_value * 100.0 / metric_all_value, 2)
-            result.update(calc_result)
+            quantiles[idx] = self.factor(value)
+        return quantiles
 
 
 def test(datafile):
@@ -244,8 +655,67 @@ def test(datafile):
     pprint(res, indent=1, width=120)
 
 
+def bench_quantiles(datafile, distinct=1000000, rounds=5):
+    """Measure calculate_quantiles on timings from datafile scaled up to `distinct` values"""
+    import random
+    import time
+
+    mms = Multimetrics({})
+    with open(datafile, 'rb') as fname:
+        res = mms.aggregate_host(fname.read(), 1, 3)
+    samples = []
+    for name, timings in res.items():
+        if mms.is_timings(name):
+            samples.extend(timings.items())
+    timings = {}
+    while len(timings) < distinct:
+        value, count = random.choice(samples)
+        timings[value + random.random() * 1e-3] = count
+    total_count = sum(timings.values())
+    print("+++ {} distinct timings, {} quantiles +++".format(len(timings), len(mms.quantile)))
+
+    engines = [("python", mms._py_calculate_quantiles)]
+    if np is not None:
+        engines.append(("numpy", mms._np_calculate_quantiles))
+    for engine, calculate in engines:
+        start = time.time()
+        for _ in range(rounds):
+            calculate(timings, total_count)
+        print("+++ Calculate quantiles {} ({} s) +++".format(engine, (time.time() - start) / rounds))
+
+
+def bench_merge(hosts=1000, metrics=5000, timings_share=0.1, distinct=20, rounds=3):
+    """Measure aggregate_group on synthetic results of `hosts` hosts with `metrics` metrics each"""
+    import random
+    import time
+
+    rnd = random.Random(0)
+    timings_count = int(metrics * timings_share)
+    names = ["svc.metric_{}.2xx".format(i) for i in range(metrics - timings_count)]
+    timings_names = ["svc.metric_{}_timings".format(i) for i in range(timings_count)]
+    samples = [round(rnd.random() * 2, 3) for _ in range(distinct * 16)]
+    payload = []
+    for _ in range(hosts):
+        res = {name: rnd.random() * 100 for name in names}
+        for name in timings_names:
+            res[name] = {value: float(rnd.randint(1, 5)) for value in rnd.sample(samples, distinct)}
+        payload.append(res)
+    print("+++ {} hosts, {} metrics, {} timings +++".format(hosts, metrics, timings_count))
+
+    mms = Multimetrics({})
+    start = time.time()
+    for _ in range(rounds):
+        mms.aggregate_group(payload)
+    print("+++ Aggregate group ({} s) +++".format((time.time() - start) / rounds))
+
+
 if __name__ == '__main__':
     import sys
     logging.basicConfig()
     logging.getLogger().setLevel(logging.DEBUG)
-    test(sys.argv[1])
+    if len(sys.argv) > 2 and sys.argv[2] == "quantiles":
+        bench_quantiles(sys.argv[1])
+    elif len(sys.argv) > 1 and sys.argv[1] == "merge":
+        bench_merge()
+    else:
+        test(sys.argv[1])
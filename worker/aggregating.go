@@ -2,6 +2,7 @@ package worker
 
 import (
 	"context"
+	"io"
 	"sync"
 	"time"
 
@@ -10,6 +11,43 @@ import (
 	"github.com/sirupsen/logrus"
 )
 
+// streamChunkSize limits payload bytes of one AggregateGroupStream message
+const streamChunkSize = 4 << 20
+
+// streamGroup sends results of hosts of all subgroups to AggregateGroupStream,
+// the aggregator folds them in to the partial state as they arrive,
+// so the metahost is not limited by the message size and its results are not kept at once
+func streamGroup(ctx context.Context, ac AggregatorClient, r *AggregateHierarchyRequest) (*AggregateGroupResponse, error) {
+	stream, err := ac.AggregateGroupStream(ctx)
+	if err != nil {
+		return nil, err
+	}
+	// task and class name are required in the first message only
+	msg := &AggregateGroupRequest{Task: r.Task, ClassName: r.ClassName}
+	size := 0
+	for _, group := range r.Groups {
+		for _, item := range group.Payload {
+			if size > 0 && size+len(item) > streamChunkSize {
+				if err := stream.Send(msg); err != nil {
+					if err == io.EOF {
+						// the stream is aborted by the aggregator, its status is returned by CloseAndRecv
+						return stream.CloseAndRecv()
+					}
+					return nil, err
+				}
+				msg = &AggregateGroupRequest{}
+				size = 0
+			}
+			msg.Payload = append(msg.Payload, item)
+			size += len(item)
+		}
+	}
+	if err := stream.Send(msg); err != nil && err != io.EOF {
+		return nil, err
+	}
+	return stream.CloseAndRecv()
+}
+
 // DoAggregating send tasks to cluster
 func DoAggregating(ctx context.Context, task *AggregatingTask) error {
 	startTm := time.Now()
@@ -31,14 +69,12 @@ func DoAggregating(ctx context.Context, task *AggregatingTask) error {
 	meta := parsingConfig.Metahost
 	ch := make(chan *senders.AggregationResult)
 
-	initCap := len(aggregationConfig.Data) * len(Hosts)
 	for name, cfg := range aggregationConfig.Data {
 		encodedCfg, err := utils.Pack(cfg)
 		if err != nil {
 			log.Errorf("failed to pack config: %v", err)
 			continue
 		}
-		aggParsingResults := make([][]byte, 0, initCap)
 		aggType, err := cfg.Type()
 		if err != nil {
 			log.Errorf("resolve type for %s: %s", name, err)
@@ -49,11 +85,23 @@ func DoAggregating(ctx context.Context, task *AggregatingTask) error {
 			log.Errorf("resolve %s Class for %s: %s", aggType, name, err)
 			continue
 		}
+		perHost, err := cfg.GetBool("perHost")
+		if err != nil {
+			log.Errorf("skip per host: %s", err)
+		}
+		skipPerDC, err := cfg.GetBool("skipPerDatacenter")
+		if skipPerDC && err == nil {
+			log.Debugf("%s skip per datacenter results by skipPerDatacenter config option", name)
+		}
 		log.Infof("send %s to %s.%s", name, aggType, aggClass)
-		ac := NewAggregatorClient(NextAggregatorConn())
 
+		var groups []*AggregateSubGroup
 		for subGroup, hosts := range Hosts {
-			subGroupParsingResults := make([][]byte, 0, initCap)
+			group := &AggregateSubGroup{
+				Name:    subGroup,
+				Hosts:   make([]string, 0, len(hosts)),
+				Payload: make([][]byte, 0, len(hosts)),
+			}
 			for _, host := range hosts {
 				key := host + ";" + name
 				data, ok := task.ParsingResult.Data[key]
@@ -61,113 +109,92 @@ func DoAggregating(ctx context.Context, task *AggregatingTask) error {
 					log.Warnf("missing result for %s", key)
 					continue
 				}
-
-				aggParsingResults = append(aggParsingResults, data)
-				subGroupParsingResults = append(subGroupParsingResults, data)
-
-				perHost, err := cfg.GetBool("perHost")
-				if !perHost || err != nil {
-					if err != nil {
-						log.Errorf("skip per host: %s", err)
-					}
-					continue
-				}
-
-				log.Debugf("host %s", host)
-				hostReq := &AggregateGroupRequest{
-					Task: &AggregatorTask{
-						Id:     task.Id,
-						Config: encodedCfg,
-						Meta: map[string]string{
-							"type":      "host",
-							"aggregate": name,
-							"name":      host,
-							"metahost":  meta,
-						},
-					},
-					ClassName: aggClass,
-					Payload:   [][]byte{data},
-				}
-				aggWg.Add(1)
-				go func(r *AggregateGroupRequest) {
-					defer aggWg.Done()
-					res, err := ac.AggregateGroup(ctx, r)
-					if err != nil {
-						log.Errorf("failed to call aggregator.AggregateGroup(%s): %v", r.Task.Meta["name"], err)
-					} else {
-						ch <- &senders.AggregationResult{Tags: r.Task.Meta, Result: res.Result}
-					}
-				}(hostReq)
+				group.Hosts = append(group.Hosts, host)
+				group.Payload = append(group.Payload, data)
 			}
-
-			if len(subGroupParsingResults) == 0 {
+			if len(group.Payload) == 0 {
 				log.Infof("%s %s nothing aggregate", name, subGroup)
 				continue
 			}
-
-			skipPerDC, err := cfg.GetBool("skipPerDatacenter")
-			if skipPerDC && err == nil {
-				log.Debugf("%s %s skip by skipPerDatacenter config option", name, subGroup)
-				continue
-			}
-
-			log.Debugf("group %s", subGroup)
-			groupReq := &AggregateGroupRequest{
-				Task: &AggregatorTask{
-					Id:     task.Id,
-					Config: encodedCfg,
-					Meta: map[string]string{
-						"type":      "datacenter",
-						"aggregate": name,
-						"name":      subGroup,
-						"metahost":  meta,
-					},
-				},
-				ClassName: aggClass,
-				Payload:   subGroupParsingResults,
-			}
-			aggWg.Add(1)
-			go func(r *AggregateGroupRequest) {
-				defer aggWg.Done()
-				res, err := ac.AggregateGroup(ctx, r)
-				if err != nil {
-					log.Errorf("failed to call aggregator.AggregateGroup(%s): %v", r.Task.Meta["name"], err)
-				} else {
-					ch <- &senders.AggregationResult{Tags: r.Task.Meta, Result: res.Result}
-				}
-			}(groupReq)
+			groups = append(groups, group)
 		}
 
-		if len(aggParsingResults) == 0 {
+		if len(groups) == 0 {
 			log.Infof("%s nothing aggregate", meta)
 			continue
 		}
 
 		log.Debugf("metahost %s", meta)
-		metaReq := &AggregateGroupRequest{
+		taskMeta := map[string]string{
+			"aggregate": name,
+			"metahost":  meta,
+		}
+		// only the metahost result is needed, its hosts are streamed
+		// instead of sending all of them in one hierarchy request
+		streamed := skipPerDC && !perHost
+		if streamed {
+			taskMeta["type"] = "metahost"
+			taskMeta["name"] = meta
+		}
+		req := &AggregateHierarchyRequest{
 			Task: &AggregatorTask{
 				Id:     task.Id,
+				Name:   task.Config,
+				Frame:  task.Frame,
 				Config: encodedCfg,
-				Meta: map[string]string{
-					"type":      "metahost",
-					"aggregate": name,
-					"name":      meta,
-					"metahost":  meta,
-				},
+				Meta:   taskMeta,
 			},
-			ClassName: aggClass,
-			Payload:   aggParsingResults,
+			ClassName:         aggClass,
+			Groups:            groups,
+			PerHost:           perHost,
+			SkipPerDatacenter: skipPerDC,
+		}
+		// sliding windows are kept by the aggregator process, so all frames
+		// of the metahost are sent to the same one
+		var windowsKey string
+		if _, ok := cfg["windows"]; ok {
+			windowsKey = task.Config + ";" + name + ";" + meta
 		}
 		aggWg.Add(1)
-		go func(r *AggregateGroupRequest) {
+		go func(r *AggregateHierarchyRequest, windowsKey string, streamed bool) {
 			defer aggWg.Done()
-			res, err := ac.AggregateGroup(ctx, r)
-			if err != nil {
-				log.Errorf("failed to call aggregator.AggregateGroup(%s): %v", meta, err)
+			var res *AggregateHierarchyResponse
+			method := "AggregateHierarchy"
+			call := func(ac AggregatorClient) (err error) {
+				res, err = ac.AggregateHierarchy(ctx, r)
+				return err
+			}
+			if streamed {
+				method = "AggregateGroupStream"
+				call = func(ac AggregatorClient) error {
+					group, err := streamGroup(ctx, ac, r)
+					if err != nil {
+						return err
+					}
+					res = &AggregateHierarchyResponse{
+						Results: []*AggregateResult{{Meta: r.Task.Meta, Result: group.Result}},
+					}
+					return nil
+				}
+			}
+			var err error
+			if windowsKey != "" {
+				err = CallAggregatorByKey(windowsKey, call)
 			} else {
-				ch <- &senders.AggregationResult{Tags: r.Task.Meta, Result: res.Result}
+				err = CallAggregator(call)
+			}
+			if err != nil {
+				log.Errorf("failed to call aggregator.%s(%s): %v", method, meta, err)
+				return
+			}
+			for _, item := range res.Results {
+				if item.Error != "" {
+					log.Errorf("failed to aggregate %s %s: %s", item.Meta["type"], item.Meta["name"], item.Error)
+					continue
+				}
+				ch <- &senders.AggregationResult{Tags: item.Meta, Result: item.Result}
 			}
-		}(metaReq)
+		}(req, windowsKey, streamed)
 	}
 
 	go func() {
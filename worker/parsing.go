@@ -110,8 +110,11 @@ func DoParsing(ctx context.Context, task *ParsingTask) (*ParsingResult, error) {
 					Payload:   blob,
 				}
 				key := task.Host + ";" + k
-				ac := NewAggregatorClient(NextAggregatorConn())
-				res, err := ac.AggregateHost(ctx, req)
+				var res *AggregateHostResponse
+				err := CallAggregator(func(ac AggregatorClient) (err error) {
+					res, err = ac.AggregateHost(ctx, req)
+					return err
+				})
 				if err != nil {
 					log.Errorf("Failed to call aggregator.AggregateHost: %v", err)
 					return
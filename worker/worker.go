@@ -1,6 +1,7 @@
 package worker
 
 import (
+	"hash/fnv"
 	"io/ioutil"
 	"os"
 	"os/exec"
@@ -18,6 +19,8 @@ import (
 	"github.com/shirou/gopsutil/process"
 	"github.com/sirupsen/logrus"
 	grpc "google.golang.org/grpc"
+	"google.golang.org/grpc/codes"
+	"google.golang.org/grpc/status"
 )
 
 var (
@@ -63,6 +66,50 @@ func NextAggregatorConn() *grpc.ClientConn {
 	return aggConnections[aggConnIdx].conn
 }
 
+// CallAggregator calls aggregator by the next connection from pool,
+// calls rejected by overloaded aggregator (ResourceExhausted) are retried
+// by other connections, each connection is tried at most once
+func CallAggregator(call func(AggregatorClient) error) error {
+	aggClientConnMutex.Lock()
+	attempts := len(aggConnections)
+	aggClientConnMutex.Unlock()
+
+	var err error
+	for i := 0; i < attempts; i++ {
+		err = call(NewAggregatorClient(NextAggregatorConn()))
+		if status.Code(err) != codes.ResourceExhausted {
+			return err
+		}
+	}
+	return err
+}
+
+// CallAggregatorByKey calls aggregator by the connection chosen by the key, so calls
+// with the same key reach the same aggregator while its connection is in the pool,
+// e.g. frames of the metahost for sliding windows. Rejected calls are retried by other
+// connections as CallAggregator does
+func CallAggregatorByKey(key string, call func(AggregatorClient) error) error {
+	hash := fnv.New32a()
+	_, _ = hash.Write([]byte(key))
+
+	aggClientConnMutex.Lock()
+	attempts := len(aggConnections)
+	first := int(hash.Sum32() % uint32(attempts))
+	aggClientConnMutex.Unlock()
+
+	var err error
+	for i := 0; i < attempts; i++ {
+		aggClientConnMutex.Lock()
+		conn := aggConnections[(first+i)%len(aggConnections)].conn
+		aggClientConnMutex.Unlock()
+		err = call(NewAggregatorClient(conn))
+		if status.Code(err) != codes.ResourceExhausted {
+			return err
+		}
+	}
+	return err
+}
+
 func spawnService(name string, target string, stopCh chan bool) (*grpc.ClientConn, error) {
 	log := logrus.WithField("source", "spawnService")
 	envServicePrefix := envPrefix + filepath.Base(name)